@@ -18,4 +18,28 @@
 # When changing this, also update the CHANGELOG.md
 __version__ = '0.1.0'
 
-from triangulate import core
+import importlib
+
+# Submodules load on first access, so that importing one of them, e.g. in a
+# worker process that needs only `exec_utils`, does not import `core` and its
+# dependencies.
+_SUBMODULES = frozenset({
+    'ast_utils',
+    'batch_utils',
+    'core',
+    'exec_utils',
+    'policy_utils',
+    'sampling_utils',
+    'source_utils',
+    'trajectory_utils',
+})
+
+
+def __getattr__(name):
+  if name in _SUBMODULES:
+    return importlib.import_module(f'{__name__}.{name}')
+  raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+  return sorted(set(globals()) | _SUBMODULES)
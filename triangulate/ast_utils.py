@@ -12,31 +12,103 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""AST utilities."""
+"""AST utilities.
+
+The analyses of statements and expressions are memoised, so each distinct
+string is parsed once however often it is queried.  Callers must not mutate
+the AST nodes they receive.
+"""
 
 import ast
+import functools
+from typing import Dict, NamedTuple, Sequence
 
 
-def is_assert_statement(statement: str) -> bool:
+class AssertAnalysis(NamedTuple):
+  """The analysis of an assert statement.
+
+  Attributes:
+    node: the assert statement's AST
+    focal_expr: the asserted expression, unparsed
+    identifiers: the identifiers in the asserted expression
+  """
+
+  node: ast.Assert
+  focal_expr: str
+  identifiers: frozenset[str]
+
+
+@functools.lru_cache(maxsize=4096)
+def analyse_assert(statement: str) -> AssertAnalysis | None:
+  """Analyse `statement` if it is an assert statement.
+
+  Args:
+    statement: source code of a statement, possibly spanning several lines
+
+  Returns:
+    The analysis of the assert statement, or None if `statement` is not one.
+  """
   try:
     parsed = ast.parse(statement.strip(" \n\t"))
-    return isinstance(parsed.body[0], ast.Assert)
   except Exception:  # pylint: disable=broad-exception-caught
-    return False
+    return None
+  if len(parsed.body) != 1 or not isinstance(parsed.body[0], ast.Assert):
+    return None
+  assert_node = parsed.body[0]
+  return AssertAnalysis(
+      node=assert_node,
+      focal_expr=ast.unparse(assert_node.test),
+      identifiers=_identifiers_in(assert_node.test),
+  )
+
+
+def is_assert_statement(statement: str) -> bool:
+  return analyse_assert(statement) is not None
 
 
 def extract_assert_expression(statement: str) -> str:
-  parsed = ast.parse(statement.strip(" \n\t"))
-  assert_node = parsed.body[0]
-  expression = assert_node.test  # pytype: disable=attribute-error
-  return ast.unparse(expression)
+  analysis = analyse_assert(statement)
+  if analysis is None:
+    raise ValueError(f"'{statement.strip()}' is not an assert statement.")
+  return analysis.focal_expr
+
+
+def get_statement(lines: Sequence[str], start: int) -> str:
+  """Return the assert statement that starts at `lines[start]`.
+
+  An assert statement may continue over several lines, e.g. within
+  parentheses.  Any other statement is returned as its first line.
+
+  Args:
+    lines: lines of source code, each ending with its newline
+    start: index of the statement's first line
+
+  Returns:
+    The source code of the statement.
+  """
+  first_line = lines[start]
+  if not first_line.lstrip().startswith("assert"):
+    return first_line
+  statement = ""
+  for end in range(start, len(lines)):
+    statement += lines[end]
+    try:
+      ast.parse(statement.strip(" \n\t"))
+    except SyntaxError:
+      continue
+    return statement
+  return first_line
 
 
 class LineVisitor(ast.NodeVisitor):
-  """Visit intra-statement lines in a Python script.
+  """Visit the first lines of the statements in a Python script.
+
+  Only statements at module level and in the bodies of definitions are
+  visited.  A decorated definition starts at its first decorator, so that no
+  probe separates a decorator from the definition it decorates.
 
   Attributes:
-    insertion_points:
+    insertion_points: the 1-based first lines of the visited statements
   """
 
   def __init__(self):
@@ -47,12 +119,16 @@ class LineVisitor(ast.NodeVisitor):
       return  # Skip multiline string literals
     elif isinstance(node, ast.Import):
       return  # Skip imports
-    elif hasattr(node, "lineno"):
-      self.insertion_points.append(node.lineno)
+    elif isinstance(node, ast.stmt):
+      decorators = getattr(node, "decorator_list", [])
+      line = min([node.lineno] + [d.lineno for d in decorators])
+      if line not in self.insertion_points[-1:]:
+        self.insertion_points.append(line)
     if isinstance(
         node, (ast.FunctionDef, ast.ClassDef, ast.AsyncFunctionDef, ast.Module)
     ):
-      self.generic_visit(node)
+      for child in node.body:
+        self.visit(child)
 
 
 def get_insertion_points(tree: ast.AST) -> list[int]:
@@ -83,9 +159,97 @@ class IdentifierExtractor(ast.NodeVisitor):
       self.visit(arg)
 
 
+def _identifiers_in(node: ast.AST) -> frozenset[str]:
+  visitor = IdentifierExtractor()
+  visitor.visit(node)
+  return frozenset(visitor.identifiers)
+
+
+@functools.lru_cache(maxsize=4096)
+def _expression_identifiers(expr: str) -> frozenset[str]:
+  return _identifiers_in(ast.parse(expr))
+
+
 def extract_identifiers(expr: str) -> set[str]:
   """Parse a Python expression and extract its identifiers."""
-  root = ast.parse(expr)
-  visitor = IdentifierExtractor()
-  visitor.visit(root)
-  return visitor.identifiers
+  return set(_expression_identifiers(expr))
+
+
+# Statements that can only rebind the names they define.
+_DEFINITIONS = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+# Expressions that can run arbitrary code or suspend the frame.
+_OPAQUE_EXPRESSIONS = (ast.Call, ast.Await, ast.Yield, ast.YieldFrom)
+
+
+def _may_rebind(statement: ast.stmt, names: frozenset[str]) -> bool:
+  """Return whether executing `statement` may change the value of `names`.
+
+  The analysis is conservative, except that it assumes operators, attribute
+  reads and subscripts have no side effects.  Any call, any store into an
+  attribute or subscript, which may alias the names' values, and any compound
+  statement other than a definition may change them.
+  """
+  if isinstance(statement, _DEFINITIONS):
+    if statement.name in names:
+      return True
+    # The body is not executed, only the decorators, defaults and bases.
+    header = [*statement.decorator_list]
+    if isinstance(statement, ast.ClassDef):
+      header += [*statement.bases, *statement.keywords]
+    else:
+      header += [*statement.args.defaults, *statement.args.kw_defaults]
+    nodes = (node for part in header if part for node in ast.walk(part))
+  elif isinstance(statement, (ast.Import, ast.ImportFrom)):
+    return any(
+        (alias.asname or alias.name.split(".")[0]) in names
+        for alias in statement.names
+    )
+  elif hasattr(statement, "body"):
+    return True
+  else:
+    nodes = ast.walk(statement)
+  for node in nodes:
+    if isinstance(node, _OPAQUE_EXPRESSIONS):
+      return True
+    if isinstance(getattr(node, "ctx", None), (ast.Store, ast.Del)):
+      if not isinstance(node, ast.Name) or node.id in names:
+        return True
+  return False
+
+
+def binding_segments(source: str, ise: str) -> Dict[int, int]:
+  """Partition a program's statements by the bindings an expression sees.
+
+  Two statements share a segment when they belong to the same block and no
+  statement between them may change the value of the identifiers in `ise`,
+  so `ise` evaluates to the same value immediately before either of them.
+  Unlike the analyses of single statements, this analysis of a whole program
+  is not memoised; `core.State` computes it once per state.
+
+  Args:
+    source: the program
+    ise: the expression whose bindings matter
+
+  Returns:
+    The segment of each statement, keyed by its 1-based first line.
+  """
+  names = frozenset(
+      node.id for node in ast.walk(ast.parse(ise)) if isinstance(node, ast.Name)
+  )
+  segments = {}
+  segment = 0
+  for node in ast.walk(ast.parse(source)):
+    for field in ("body", "orelse", "finalbody"):
+      block = getattr(node, field, None)
+      if not isinstance(block, list) or not block:
+        continue
+      segment += 1
+      previous = None
+      for statement in block:
+        if not isinstance(statement, ast.stmt):
+          continue
+        if previous is not None and _may_rebind(previous, names):
+          segment += 1
+        segments.setdefault(statement.lineno, segment)
+        previous = statement
+  return segments
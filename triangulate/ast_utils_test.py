@@ -38,12 +38,84 @@ class ASTTest(absltest.TestCase):
     # TODO(etbarr): Verify whether `insertion_points` is correct.
     self.assertLen(insertion_points, 7)
 
+  def test_insertion_points_precede_decorators(self):
+    source = """\
+import functools
+
+@functools.lru_cache(
+    maxsize=None)
+def double(
+    x):
+  y = 2 * x
+  return y
+
+print(double(3))
+"""
+    insertion_points = ast_utils.get_insertion_points(ast.parse(source))
+    self.assertEqual(insertion_points, [3, 7, 8, 10])
+    lines = source.splitlines(keepends=True)
+    for line in insertion_points:
+      indent = lines[line - 1][: -len(lines[line - 1].lstrip())]
+      probed = lines[: line - 1] + [indent + "pass\n"] + lines[line - 1 :]
+      compile("".join(probed), "<probed>", "exec")
+
   def test_extract_identifiers(self):
     test_expr = "x + y * foo(z,c)"
     test_expr_fv = set(["c", "x", "y", "z"])
     fv = ast_utils.extract_identifiers(test_expr)
     self.assertEqual(test_expr_fv, set(fv))
 
+  def test_extract_identifiers_returns_fresh_sets(self):
+    ast_utils.extract_identifiers("x + y").pop()
+    self.assertEqual(ast_utils.extract_identifiers("x + y"), {"x", "y"})
+
+  def test_analyse_assert_is_memoised(self):
+    statement = "  assert total == 5, 'not five'\n"
+    analysis = ast_utils.analyse_assert(statement)
+    self.assertIs(ast_utils.analyse_assert(statement), analysis)
+    self.assertEqual(analysis.focal_expr, "total == 5")
+    self.assertEqual(analysis.identifiers, {"total"})
+    self.assertIsNone(ast_utils.analyse_assert("total = 5\n"))
+
+  def test_get_statement_spans_multiline_asserts(self):
+    lines = [
+        "if True:\n",
+        "  assert (total ==\n",
+        "          5), 'not five'\n",
+        "  total = 6\n",
+    ]
+    statement = ast_utils.get_statement(lines, 1)
+    self.assertEqual(statement, lines[1] + lines[2])
+    self.assertEqual(
+        ast_utils.extract_assert_expression(statement), "total == 5"
+    )
+    self.assertEqual(ast_utils.get_statement(lines, 3), lines[3])
+    self.assertFalse(ast_utils.is_assert_statement(lines[1]))
+
+  def test_binding_segments(self):
+    source = (
+        "x = 1\n"  # 1
+        "y = x + 1\n"  # 2
+        "if y:\n"  # 3
+        "  z = 2\n"  # 4
+        "  x = 3\n"  # 5
+        "  w = 4\n"  # 6
+        "items[0] = 5\n"  # 7
+        "def g():\n"  # 8
+        "  return x\n"  # 9
+        "print(x)\n"  # 10
+        "y = 6\n"  # 11
+    )
+    segments = ast_utils.binding_segments(source, "x > 1")
+    self.assertNotEqual(segments[1], segments[2])
+    self.assertEqual(segments[2], segments[3])
+    self.assertEqual(segments[4], segments[5])
+    self.assertNotEqual(segments[5], segments[6])
+    self.assertNotEqual(segments[3], segments[4])
+    self.assertNotEqual(segments[3], segments[7])
+    self.assertEqual(segments[8], segments[10])
+    self.assertNotEqual(segments[10], segments[11])
+
 
 if __name__ == "__main__":
   absltest.main()
@@ -0,0 +1,113 @@
+# Copyright 2023 The triangulate Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Batch script, which localises every subject of a manifest."""
+
+from absl import app
+from absl import flags
+from absl import logging
+from triangulate import batch_utils
+
+flags.DEFINE_string(
+    "manifest",
+    None,
+    required=True,
+    help=(
+        "A JSONL or CSV manifest of subjects; see `batch_utils` for its "
+        "columns."
+    ),
+)
+flags.DEFINE_string(
+    "output_dir",
+    None,
+    required=True,
+    help=(
+        "Directory of per-subject results and the batch summary; rerunning "
+        "a batch skips the subjects that already have results."
+    ),
+)
+flags.DEFINE_integer(
+    "max_workers",
+    None,
+    help="Number of worker processes (default: the number of cores).",
+)
+flags.DEFINE_float(
+    "subject_timeout",
+    None,
+    help="Seconds after which to give up on a subject (default: never).",
+)
+flags.DEFINE_bool(
+    "retry_failed",
+    False,
+    help="Rerun subjects whose earlier attempt failed.",
+)
+flags.DEFINE_integer(
+    "max_steps",
+    10,
+    short_name="m",
+    help="maximum simulation steps, for subjects that set none",
+)
+flags.DEFINE_enum(
+    "policy",
+    "random",
+    ["random", "linear_bandit"],
+    help="How the localiser chooses where to insert probes.",
+)
+flags.DEFINE_bool(
+    "deterministic_replay",
+    False,
+    help="Pin each subject's sources of nondeterminism.",
+)
+flags.DEFINE_bool(
+    "early_termination",
+    False,
+    help="Stop each execution once its probes have observed the illegal state.",
+)
+flags.DEFINE_integer(
+    "loglevel",
+    0,
+    short_name="l",
+    help="Set logging level (default: INFO)",
+)
+
+
+def main(argv):
+  """Program entry point."""
+
+  if len(argv) > 1:
+    raise app.UsageError("Too many command-line arguments.")
+
+  logging.set_verbosity(flags.FLAGS.loglevel)
+
+  subjects = batch_utils.read_manifest(flags.FLAGS.manifest)
+  summary = batch_utils.run_batch(
+      subjects,
+      flags.FLAGS.output_dir,
+      max_workers=flags.FLAGS.max_workers,
+      retry_failed=flags.FLAGS.retry_failed,
+      timeout=flags.FLAGS.subject_timeout,
+      max_steps=flags.FLAGS.max_steps,
+      policy=flags.FLAGS.policy,
+      deterministic_replay=flags.FLAGS.deterministic_replay,
+      early_termination=flags.FLAGS.early_termination,
+  )
+  logging.info(
+      "Localised %d of %d subjects.", summary["succeeded"], summary["subjects"]
+  )
+  if summary["failed"]:
+    logging.warning("Failed subjects: %s", ", ".join(summary["failed"]))
+
+
+if __name__ == "__main__":
+  app.run(main)
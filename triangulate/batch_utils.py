@@ -0,0 +1,369 @@
+# Copyright 2023 The triangulate Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Batch utilities.
+
+A manifest lists the subjects of a batch, one per JSONL line or CSV row, with
+the columns `buggy_program_name`, `illegal_state_expr`, `bug_trap` and
+`bug_triggering_input`, and optionally `id`, `entry_module` and `max_steps`.
+Relative program names are resolved against the manifest's directory.
+
+Each subject is localised in a fresh worker process, so that a subject that
+crashes its interpreter, or leaves modules, random state or monkeypatches
+behind, affects no other subject.  Each subject's result is written to
+`<output_dir>/results/<id>.json` as soon as the subject finishes, so a rerun
+of an interrupted batch skips the subjects that already have results.
+"""
+
+import collections
+import csv
+import dataclasses
+import hashlib
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import re
+import tempfile
+import time
+import traceback
+from typing import Any, Dict, Iterator, List, Sequence
+
+from absl import logging
+from triangulate import core
+from triangulate import policy_utils
+
+RESULTS_DIRECTORY = "results"
+SUMMARY_FILENAME = "summary.json"
+_ID_PATTERN = re.compile(r"[\w.-]+$")
+
+
+@dataclasses.dataclass(frozen=True)
+class Subject:
+  """A subject of a batch and its bug.
+
+  Attributes:
+    id: identifies the subject's result within the batch
+    buggy_program_name: path to the buggy file or package directory
+    illegal_state_expr: the complement of the bug trap's assertion
+    bug_trap: offset of the assertion that traps the bug
+    bug_triggering_input: a bug-triggering input
+    entry_module: path of the module to instrument, for package subjects
+    max_steps: maximum simulation steps, or None for the batch's default
+  """
+
+  id: str
+  buggy_program_name: str
+  illegal_state_expr: str
+  bug_trap: int
+  bug_triggering_input: str = ""
+  entry_module: str | None = None
+  max_steps: int | None = None
+
+
+def _subject_from_row(row: Dict[str, Any], directory: str) -> Subject:
+  """Build a subject from a manifest row, whose values may all be strings."""
+  row = {key: value for key, value in row.items() if value not in (None, "")}
+  program = os.path.join(directory, row["buggy_program_name"])
+  subject_id = row.get("id")
+  if subject_id is None:
+    key = json.dumps(row, sort_keys=True).encode("utf-8")
+    digest = hashlib.blake2b(key, digest_size=4).hexdigest()
+    name = os.path.splitext(os.path.basename(program.rstrip(os.sep)))[0]
+    subject_id = f"{name}-{digest}"
+  subject_id = str(subject_id)
+  if not _ID_PATTERN.match(subject_id):
+    raise ValueError(f"Error: invalid subject id {subject_id!r}.")
+  max_steps = row.get("max_steps")
+  return Subject(
+      id=subject_id,
+      buggy_program_name=program,
+      illegal_state_expr=row["illegal_state_expr"],
+      bug_trap=int(row["bug_trap"]),
+      bug_triggering_input=str(row.get("bug_triggering_input", "")),
+      entry_module=row.get("entry_module"),
+      max_steps=None if max_steps is None else int(max_steps),
+  )
+
+
+def read_manifest(path: str) -> List[Subject]:
+  """Read the subjects of a JSONL or CSV manifest.
+
+  Args:
+    path: the manifest, whose extension, `.csv` or otherwise, gives its format
+
+  Returns:
+    The manifest's subjects, in order.
+
+  Raises:
+    ValueError if two subjects share an id or an id is not a valid filename.
+  """
+  directory = os.path.dirname(os.path.abspath(path))
+  with open(path, newline="", encoding="utf-8") as f:
+    if path.endswith(".csv"):
+      rows = list(csv.DictReader(f))
+    else:
+      rows = [json.loads(line) for line in f if line.strip()]
+  subjects = [_subject_from_row(row, directory) for row in rows]
+  seen = set()
+  for subject in subjects:
+    if subject.id in seen:
+      raise ValueError(f"Error: duplicate subject id {subject.id!r}.")
+    seen.add(subject.id)
+  return subjects
+
+
+def _write_json(path: str, value: Any) -> None:
+  """Atomically replace `path` with the JSON encoding of `value`."""
+  fd, partial_path = tempfile.mkstemp(
+      dir=os.path.dirname(path), prefix=".", suffix=".tmp"
+  )
+  try:
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+      json.dump(value, f, indent=2, sort_keys=True)
+      f.write("\n")
+    os.replace(partial_path, path)
+  except BaseException:
+    os.unlink(partial_path)
+    raise
+
+
+def result_path(output_dir: str, subject_id: str) -> str:
+  """Return the path of the result of the subject `subject_id`."""
+  return os.path.join(output_dir, RESULTS_DIRECTORY, subject_id + ".json")
+
+
+def localise(
+    subject: Subject,
+    max_steps: int = 10,
+    policy: str = "random",
+    deterministic_replay: bool = False,
+    early_termination: bool = False,
+) -> Dict[str, Any]:
+  """Run a localisation episode on a subject.
+
+  Args:
+    subject: the subject to localise
+    max_steps: maximum simulation steps, unless the subject sets its own
+    policy: how to place probes, either "random" or "linear_bandit"
+    deterministic_replay: whether to pin the subject's nondeterminism
+    early_termination: whether to stop executions once probes suffice
+
+  Returns:
+    The subject's result, which records whether the episode succeeded and,
+    if so, its steps, rewards and the last execution's observations.
+  """
+  start = time.perf_counter()
+  result = {"id": subject.id, "subject": dataclasses.asdict(subject)}
+  env = None
+  try:
+    env = core.Environment(
+        buggy_program_name=subject.buggy_program_name,
+        illegal_state_expr=subject.illegal_state_expr,
+        bug_triggering_input=subject.bug_triggering_input,
+        bug_trap=subject.bug_trap,
+        burnin=0,
+        max_steps=subject.max_steps or max_steps,
+        probe_output_filename="",
+        deterministic_replay=deterministic_replay,
+        entry_module=subject.entry_module,
+        early_termination=early_termination,
+    )
+    if policy == "linear_bandit":
+      localiser = core.Localiser(env, policy=policy_utils.LinearBanditPolicy())
+    else:
+      localiser = core.Localiser(env)
+    while not env.terminate():
+      env.update(localiser.pick_action(env.state, env.reward()))
+    result.update(
+        status="ok",
+        steps=env.steps,
+        reward=env.reward(),
+        total_reward=localiser.total_reward,
+        probe_offsets=list(env.state.overlay.offsets),
+        observations=[list(o) for o in env.observations],
+    )
+  # Subjects may exit or raise anything; record it rather than end the batch.
+  except (Exception, SystemExit) as e:  # pylint:disable=broad-exception-caught
+    logging.error("Error: subject %s failed: %r", subject.id, e)
+    result.update(
+        status="failed",
+        error=repr(e),
+        traceback=traceback.format_exc(),
+    )
+  finally:
+    if env is not None:
+      env.cleanup()
+  result["seconds"] = time.perf_counter() - start
+  return result
+
+
+def _localise_and_checkpoint(
+    subject: Subject, output_dir: str, **kwargs
+) -> Dict[str, Any]:
+  result = localise(subject, **kwargs)
+  _write_json(result_path(output_dir, subject.id), result)
+  return result
+
+
+def _failed_result(
+    subject: Subject, error: str, seconds: float
+) -> Dict[str, Any]:
+  return {
+      "id": subject.id,
+      "subject": dataclasses.asdict(subject),
+      "status": "failed",
+      "error": error,
+      "seconds": seconds,
+  }
+
+
+def _read_result(output_dir: str, subject_id: str) -> Dict[str, Any] | None:
+  try:
+    with open(result_path(output_dir, subject_id), encoding="utf-8") as f:
+      return json.load(f)
+  except FileNotFoundError:
+    return None
+
+
+def _localise_in_workers(
+    subjects: Sequence[Subject],
+    output_dir: str,
+    max_workers: int | None,
+    timeout: float | None,
+    **kwargs,
+) -> Iterator[Dict[str, Any]]:
+  """Localise each subject in a worker process of its own.
+
+  A worker that dies without checkpointing its subject's result, or that
+  runs longer than `timeout` seconds and is killed, is recorded as failed.
+
+  Args:
+    subjects: the subjects to localise
+    output_dir: the directory of the batch's results
+    max_workers: number of concurrent workers, by default the number of cores
+    timeout: seconds after which to give up on a subject, or None to wait
+    **kwargs: passed to `localise`
+
+  Yields:
+    Each subject's result, in the order the subjects finish.
+  """
+  max_workers = max_workers or os.cpu_count() or 1
+  context = multiprocessing.get_context()
+  queue = collections.deque(subjects)
+  running = {}
+  try:
+    while queue or running:
+      while queue and len(running) < max_workers:
+        subject = queue.popleft()
+        # Only a result the worker writes may record its subject's outcome.
+        if os.path.exists(result_path(output_dir, subject.id)):
+          os.remove(result_path(output_dir, subject.id))
+        process = context.Process(
+            target=_localise_and_checkpoint,
+            args=(subject, output_dir),
+            kwargs=kwargs,
+            daemon=True,
+        )
+        process.start()
+        running[process.sentinel] = (process, subject, time.monotonic())
+      wait_seconds = None
+      if timeout is not None:
+        deadline = min(start for _, _, start in running.values()) + timeout
+        wait_seconds = max(deadline - time.monotonic(), 0)
+      finished = multiprocessing.connection.wait(list(running), wait_seconds)
+      for sentinel, (process, subject, start) in list(running.items()):
+        seconds = time.monotonic() - start
+        if sentinel in finished:
+          process.join()
+          result = _read_result(output_dir, subject.id)
+          error = f"worker exited with status {process.exitcode}"
+        elif timeout is not None and seconds >= timeout:
+          process.kill()
+          process.join()
+          result = None
+          error = f"timed out after {timeout:g} seconds"
+        else:
+          continue
+        del running[sentinel]
+        if result is None:
+          logging.error("Error: subject %s failed: %s", subject.id, error)
+          result = _failed_result(subject, error, seconds)
+          _write_json(result_path(output_dir, subject.id), result)
+        yield result
+  finally:
+    for process, _, _ in running.values():
+      process.kill()
+      process.join()
+
+
+def run_batch(
+    subjects: Sequence[Subject],
+    output_dir: str,
+    max_workers: int | None = None,
+    retry_failed: bool = False,
+    timeout: float | None = None,
+    **kwargs,
+) -> Dict[str, Any]:
+  """Localise each subject in its own worker process and summarise them.
+
+  Subjects that already have a result in `output_dir` are skipped, as are
+  failed subjects unless `retry_failed`.
+
+  Args:
+    subjects: the subjects of the batch
+    output_dir: the directory of the batch's results and summary
+    max_workers: number of worker processes, by default the number of cores
+    retry_failed: whether to rerun subjects whose earlier attempt failed
+    timeout: seconds after which to give up on a subject, or None to wait
+    **kwargs: passed to `localise`
+
+  Returns:
+    The batch's summary, which is also written to `SUMMARY_FILENAME`.
+  """
+  os.makedirs(os.path.join(output_dir, RESULTS_DIRECTORY), exist_ok=True)
+  results = {}
+  pending = []
+  for subject in subjects:
+    result = _read_result(output_dir, subject.id)
+    if result is None or (retry_failed and result["status"] != "ok"):
+      pending.append(subject)
+    else:
+      results[subject.id] = result
+  logging.info(
+      "Localising %d subjects; %d already have results.",
+      len(pending),
+      len(results),
+  )
+
+  start = time.perf_counter()
+  for result in _localise_in_workers(
+      pending, output_dir, max_workers, timeout, **kwargs
+  ):
+    results[result["id"]] = result
+    logging.info("Subject %s: %s.", result["id"], result["status"])
+
+  ordered = [results[subject.id] for subject in subjects]
+  failed = [result["id"] for result in ordered if result["status"] != "ok"]
+  summary = {
+      "subjects": len(ordered),
+      "succeeded": len(ordered) - len(failed),
+      "failed": failed,
+      "resumed": len(ordered) - len(pending),
+      "rewarded": sum(result.get("reward", 0) for result in ordered),
+      "subject_seconds": sum(result["seconds"] for result in ordered),
+      "wall_seconds": time.perf_counter() - start,
+  }
+  _write_json(os.path.join(output_dir, SUMMARY_FILENAME), summary)
+  return summary
@@ -0,0 +1,145 @@
+# Copyright 2023 The triangulate Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for batch_utils."""
+
+import json
+import os
+import tempfile
+
+from absl.testing import absltest
+from triangulate import batch_utils
+
+TESTDATA_DIRECTORY = os.path.join(
+    absltest.get_default_test_srcdir(),
+    "triangulate/testdata",
+)
+
+
+def _write(path, text):
+  with open(path, "w", encoding="utf-8") as f:
+    f.write(text)
+
+
+class BatchTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.directory = self.enter_context(tempfile.TemporaryDirectory())
+    self.output_dir = os.path.join(self.directory, "output")
+
+  def test_read_csv_manifest(self):
+    manifest = os.path.join(self.directory, "manifest.csv")
+    _write(
+        manifest,
+        "id,buggy_program_name,illegal_state_expr,bug_trap,max_steps\n"
+        "calc,calculator.py,total != 5,26,\n"
+        ",dice.py,roll > 6,25,3\n",
+    )
+    calculator, dice = batch_utils.read_manifest(manifest)
+    self.assertEqual(calculator.id, "calc")
+    self.assertEqual(
+        calculator.buggy_program_name,
+        os.path.join(self.directory, "calculator.py"),
+    )
+    self.assertEqual(calculator.bug_trap, 26)
+    self.assertIsNone(calculator.max_steps)
+    self.assertStartsWith(dice.id, "dice-")
+    self.assertEqual(dice.max_steps, 3)
+
+  def test_duplicate_ids_are_rejected(self):
+    manifest = os.path.join(self.directory, "manifest.jsonl")
+    row = dict(
+        id="calc",
+        buggy_program_name="calculator.py",
+        illegal_state_expr="total != 5",
+        bug_trap=26,
+    )
+    _write(manifest, f"{json.dumps(row)}\n{json.dumps(row)}\n")
+    with self.assertRaisesRegex(ValueError, "duplicate"):
+      batch_utils.read_manifest(manifest)
+
+  def test_batch_resumes_and_records_failures(self):
+    subjects = [
+        batch_utils.Subject(
+            id="calculator",
+            buggy_program_name=os.path.join(
+                TESTDATA_DIRECTORY, "calculator.py"
+            ),
+            illegal_state_expr="total != 5",
+            bug_trap=26,
+        ),
+        batch_utils.Subject(
+            id="missing",
+            buggy_program_name=os.path.join(self.directory, "missing.py"),
+            illegal_state_expr="x",
+            bug_trap=0,
+        ),
+    ]
+    summary = batch_utils.run_batch(
+        subjects,
+        self.output_dir,
+        max_workers=2,
+        max_steps=2,
+        deterministic_replay=True,
+    )
+    self.assertEqual(summary["succeeded"], 1)
+    self.assertEqual(summary["failed"], ["missing"])
+    self.assertEqual(summary["resumed"], 0)
+    with open(batch_utils.result_path(self.output_dir, "calculator")) as f:
+      result = json.load(f)
+    self.assertEqual(result["status"], "ok")
+    self.assertEqual(result["steps"], 2)
+
+    summary = batch_utils.run_batch(subjects, self.output_dir, max_workers=2)
+    self.assertEqual(summary["resumed"], 2)
+    with open(os.path.join(self.output_dir, "summary.json")) as f:
+      self.assertEqual(json.load(f)["failed"], ["missing"])
+
+  def test_crashing_and_hanging_subjects_fail_alone(self):
+    crashing = os.path.join(self.directory, "crashing.py")
+    _write(crashing, "import os\nx = 1\nassert x == 1\nos._exit(3)\n")
+    hanging = os.path.join(self.directory, "hanging.py")
+    _write(hanging, "import time\nx = 1\nassert x == 1\ntime.sleep(60)\n")
+    subjects = [
+        batch_utils.Subject(
+            id=os.path.splitext(os.path.basename(program))[0],
+            buggy_program_name=program,
+            illegal_state_expr="x != 1",
+            bug_trap=2,
+        )
+        for program in (crashing, hanging)
+    ]
+    subjects.append(
+        batch_utils.Subject(
+            id="calculator",
+            buggy_program_name=os.path.join(
+                TESTDATA_DIRECTORY, "calculator.py"
+            ),
+            illegal_state_expr="total != 5",
+            bug_trap=26,
+        )
+    )
+    summary = batch_utils.run_batch(
+        subjects, self.output_dir, max_workers=2, timeout=1, max_steps=1
+    )
+    self.assertEqual(summary["failed"], ["crashing", "hanging"])
+    with open(batch_utils.result_path(self.output_dir, "crashing")) as f:
+      self.assertEqual(json.load(f)["error"], "worker exited with status 3")
+    with open(batch_utils.result_path(self.output_dir, "hanging")) as f:
+      self.assertEqual(json.load(f)["error"], "timed out after 1 seconds")
+
+
+if __name__ == "__main__":
+  absltest.main()
@@ -15,20 +15,37 @@
 """This is executable pseudocode for an RL localiser."""
 
 import ast
+import collections
 import contextlib
+import hashlib
 import io
 import math
 import os
 import shutil
+import subprocess
+import sys
 import tempfile
-from typing import List, TextIO, Tuple
+import time
+from typing import Counter, Dict, List, TextIO, Tuple
 
 from absl import logging
 import numpy as np
 from triangulate import ast_utils
+from triangulate import exec_utils
+from triangulate import policy_utils
 from triangulate import sampling_utils
-
-rng = np.random.default_rng(seed=654)
+from triangulate import source_utils
+from triangulate import trajectory_utils
+
+# The directory holding the triangulate package, for worker subprocesses.
+_PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_WORKER_BOOTSTRAP = (
+    "import sys; from triangulate import exec_utils; exec_utils.main(sys.argv)"
+)
+# Every line a probe prints starts with this prefix.
+PROBE_PREFIX = exec_utils.PROBE_PREFIX
+# How trajectories encode the printed values of illegal state expressions.
+_OBSERVATION_CODES = {"True": 1, "False": 0}
 
 ################################################################################
 # Utils
@@ -51,6 +68,57 @@ def write_lines_to_file(
     descriptor.write(line)
 
 
+def parse_observations(output: str, ise: str) -> List[Tuple[int, str]]:
+  """Extract the observations of the illegal state expression from output.
+
+  Args:
+      output:  The output of an instrumented subject
+      ise:  The illegal state expression the probes evaluated
+
+  Returns:
+      The offset of the reporting probe and the value it observed, as
+      printed, for each observation in the order the probes fired.
+  """
+  return [
+      (int(match.group(1)), match.group(2))
+      for match in exec_utils.observation_pattern(ise).finditer(output)
+  ]
+
+
+def bracketing_offsets(observations: List[Tuple[int, str]]) -> List[int]:
+  """Return the offsets of the probes that bracket the illegal state.
+
+  Args:
+      observations:  The offset and observed value of each probe, in the
+        order the probes fired
+
+  Returns:
+      The offsets of the last probe to fire before the first observation of
+      the illegal state expression as true, and of that first observation,
+      or no offsets if it was never observed true.
+  """
+  for i, (offset, value) in enumerate(observations):
+    if value == "True":
+      return [observations[i - 1][0], offset] if i else [offset]
+  return []
+
+
+def strip_probe_output(output: str) -> str:
+  """Remove the lines that probes printed from a subject's output.
+
+  Args:
+      output:  The output of an instrumented subject
+
+  Returns:
+      The output the subject itself produced.
+  """
+  return "".join(
+      line
+      for line in output.splitlines(keepends=True)
+      if not line.startswith(PROBE_PREFIX)
+  )
+
+
 ################################################################################
 # Barebones RL
 ################################################################################
@@ -59,10 +127,18 @@ def write_lines_to_file(
 class State:
   """State generated by the environment and passed to the agent in RL loop.
 
-  Attributes: codeview : [str] code lines in current agent window ise : str
-  illegal state expression focal_expr : str current expression
+  Attributes: codeview : [str] fragments of the instrumented program: runs
+  of source lines and the probes between them ise : str illegal state
+  expression focal_expr : str current expression
       descriptor: file descriptor of program being debugged
       probes: [str x int] list of probes, which pair a query and an offset.
+      bug_trap: offset of the assertion that traps the bug
+      source: the subject's source, shared with other episodes on it
+      overlay: the probes inserted into `source`, which together with it
+        make up the codeview
+      insertion_points: [int] lines before which probes may be inserted, or
+        None to consider every statement
+      insertion_weights: optional weight of each insertion point
   """
 
   def set_ise(self, ise: str) -> None:
@@ -75,6 +151,7 @@ class State:
       # e.add_note(err_template % expr)
       raise e
     self.ise = ise
+    self._binding_segments = None
 
   def set_focal_expr(self, focal_expr: str) -> None:
     try:
@@ -93,24 +170,34 @@ class State:
       ise: str,
       bug_trap: int,
       probes: List[Tuple[int, str]] | None = None,
+      source: source_utils.SourceText | None = None,
   ):
-    self.codeview = descriptor.readlines()  # TODO(etbarr): catch exceptions?
+    # TODO(etbarr): catch exceptions?
+    if source is None:
+      source = source_utils.intern_source(descriptor.read())
+    self.source = source
+    self._statement_lines = None
+    self.overlay = source_utils.ProbeOverlay()
     error_message = "bug trap out of bounds"
-    assert 0 <= bug_trap and bug_trap < len(self.codeview), error_message
+    assert 0 <= bug_trap and bug_trap < len(self.source), error_message
     self.set_ise(ise)
-    if not ast_utils.is_assert_statement(self.codeview[bug_trap]):
+    bug_trap_statement = ast_utils.get_statement(self.source, bug_trap)
+    if not ast_utils.is_assert_statement(bug_trap_statement):
       raise ValueError(
           "Bug_trap must identify an assertion statement, but"
           f" codeview[bug_trap={bug_trap}] ="
-          f" '{self.codeview[bug_trap].strip()}', which is not."
+          f" '{self.source[bug_trap].strip()}', which is not."
       )
-    focal_expr = ast_utils.extract_assert_expression(self.codeview[bug_trap])
+    focal_expr = ast_utils.extract_assert_expression(bug_trap_statement)
     self.set_focal_expr(focal_expr)
+    self.bug_trap = bug_trap
     self.descriptor = descriptor
     if probes is None:
       self.probes = []
     else:
       self.probes = probes
+    self.insertion_points = None
+    self.insertion_weights = None
 
   def get_illegal_state_expr_ids(self):
     """Return identifiers in the illegal state expression.
@@ -120,24 +207,57 @@ class State:
     """
     return ast_utils.extract_identifiers(self.ise)
 
+  def get_binding_segments(self) -> Dict[int, int]:
+    """Return the binding segment of each statement, keyed by its first line.
+
+    The source is decoded and analysed once per state, not at every step.
+
+    Returns:
+        The segments `ast_utils.binding_segments` computes for the source
+        and the illegal state expression
+    """
+    if self._binding_segments is None:
+      self._binding_segments = ast_utils.binding_segments(
+          self.source.text(), self.ise
+      )
+    return self._binding_segments
+
+  def get_statement_lines(self) -> List[int]:
+    """Return the first line of every statement into which probes may go.
+
+    The source is decoded and parsed once per state, not at every step.
+
+    Returns:
+        The insertion points `ast_utils.get_insertion_points` computes
+    """
+    if self._statement_lines is None:
+      tree = ast.parse(self.source.text())
+      self._statement_lines = ast_utils.get_insertion_points(tree)
+    return self._statement_lines
+
   def illegal_bindings(self) -> str | None:
     """Return f-string for reporting illegal bindings.
 
     Returns:
         Returns an f-string over the illegal bindings
     """
-    idents = self.get_illegal_state_expr_ids()
+    idents = sorted(self.get_illegal_state_expr_ids())
     if not idents:
       return None
-    ident = idents.pop()
-    bindings = f"{ident} = " + "{" + f"{ident}" + "}"
-    for ident in idents:
-      bindings += f", {ident} = " + "{" + f"{ident}" + "}"
-    return bindings
+    return ", ".join(f"{ident} = " + "{" + f"{ident}" + "}" for ident in idents)
+
+  @property
+  def codeview(self) -> List[str]:
+    """The source with the overlay's probes inserted, as fragments.
+
+    Each fragment is a run of source lines or a probe, possibly spanning
+    several lines; the fragments concatenate to the instrumented program.
+    """
+    return self.overlay.materialise(self.source)
 
   def get_codeview(self) -> List[str]:
-    """Return codeview."""
-    return self.codeview
+    """Return the lines of the instrumented program, with their newlines."""
+    return "".join(self.codeview).splitlines(keepends=True)
 
   def to_string(self):
     """Convert object into string representation.
@@ -196,9 +316,11 @@ class Agent:
         None
     """
     for offset, probe in probes:
-      state.codeview.insert(offset, probe)
+      state.overlay.add(offset, probe)
     state.descriptor.seek(0)
     state.descriptor.writelines(state.codeview)
+    state.descriptor.truncate()
+    state.descriptor.flush()
 
   def repr(self) -> str:
     """Convert object into string representation.
@@ -212,16 +334,29 @@ class Agent:
 class Localiser(Agent):
   """Represent the localiser agent.
 
-  Attributes: codeview : [str] code lines in current agent window ise : str
-  illegal state expression focal_expression : str current expression
+  Attributes: codeview : [str] fragments of the instrumented program: runs
+  of source lines and the probes between them ise : str illegal state
+  expression focal_expression : str current expression
       descriptor: file descriptor to copy of program being debugged
       probes: [str x int] list of probes, which pair a query and an offset.
 
+      policy: optional policy that chooses where to probe; without one,
+        probes are placed at random
+
   Methods:
       generate_probes(self, state) -> []:
       pick_action(self, state : State, reward: int) -> None:
   """
 
+  def __init__(
+      self,
+      env,
+      total_reward: int = 0,
+      policy: policy_utils.Policy | None = None,
+  ):
+    super().__init__(env, total_reward)
+    self.policy = policy
+
   def _generate_probes_random(self, state):
     """Generate probes for the given state.
 
@@ -232,27 +367,103 @@ class Localiser(Agent):
       List of probes, which pair queries and offsets
     """
 
-    state.descriptor.seek(0)
-    tree = ast.parse(state.descriptor.read())
-    insertion_points = ast_utils.get_insertion_points(tree)
-    samples = sampling_utils.sample_zipfian(1, len(insertion_points))
-    offsets = sampling_utils.sample_wo_replacement_uniform(
-        samples[0], insertion_points
+    insertion_points = self._get_insertion_points(state)
+    samples = sampling_utils.sample_zipfian(
+        1, support_size=len(insertion_points)
     )
-    offsets.sort()
+    if state.insertion_weights is None:
+      lines = sampling_utils.sample_wo_replacement_uniform(
+          samples[0], insertion_points
+      )
+    else:
+      lines = sampling_utils.sample_wo_replacement_weighted(
+          samples[0], insertion_points, state.insertion_weights
+      )
+    return self._make_probes(state, lines)
 
-    ise = (
-        f"Illegal state predicate: '{state.ise}' = "
-        + "{eval("
-        + repr(state.ise)
-        + ")}; "
-    )
-    isb = f"bindings: {state.illegal_bindings()}"
-    query = 'f"' + ise + isb + '"'
+  def _generate_probes_policy(self, state):
+    """Generate probes at the insertion points the policy chooses.
+
+    Args:
+      state: current state
+
+    Returns:
+      List of probes, which pair queries and offsets
+    """
+    # Lines that see the same bindings as an existing probe add nothing.
+    segments = state.get_binding_segments()
+    probed_segments = self._probed_segments(state, segments)
+    insertion_points = np.asarray(self._get_insertion_points(state))
+    candidates = np.flatnonzero([
+        segments.get(line, -line) not in probed_segments
+        for line in insertion_points
+    ])
+    if not candidates.size:
+      return self._make_probes(state, [])
+    insertion_points = insertion_points[candidates]
+    if state.insertion_weights is None:
+      hits = None
+    else:
+      hits = state.insertion_weights[candidates]
+    features = policy_utils.features_for_state(state, insertion_points, hits)
+    lines = self.policy.select(features, insertion_points)
+    probes = self._make_probes(state, lines)
+    self.policy.retain(np.array([offset + 1 for offset, _ in probes]))
+    return probes
+
+  def _get_insertion_points(self, state) -> List[int]:
+    """Return the state's insertion points, defaulting to every statement."""
+    if state.insertion_points is not None:
+      return state.insertion_points
+    return state.get_statement_lines()
+
+  def _probed_segments(self, state, segments) -> set[int]:
+    """Return the binding segments that the state's overlay already probes.
 
+    Args:
+      state: current state
+      segments: the binding segment of each line, from
+        `State.get_binding_segments`; lines without one are their own segment
+
+    Returns:
+      The segments of the overlay's probes.
+    """
+    return {
+        segments.get(offset + 1, -offset - 1)
+        for offset in state.overlay.offsets
+    }
+
+  def _make_probes(self, state, lines) -> List[Tuple[int, str]]:
+    """Make the probes that query the state before each of the given lines.
+
+    Args:
+      state: current state
+      lines: 1-based lines before which to insert probes
+
+    Returns:
+      List of probes, which pair queries and offsets
+    """
+    # Insertion points are 1-based lines; a probe precedes its line.  Of the
+    # lines that see the same bindings of the illegal state expression, only
+    # the first needs a probe, and none if the overlay already probes one.
+    segments = state.get_binding_segments()
+    offsets = []
+    probed_segments = self._probed_segments(state, segments)
+    for line in sorted(set(lines)):
+      segment = segments.get(line, -line)
+      if segment not in probed_segments:
+        probed_segments.add(segment)
+        offsets.append(line - 1)
+
+    identifiers = state.get_illegal_state_expr_ids()
     probes = []
     for offset in offsets:
-      probes.append((offset, f"print({query})\n"))
+      line = state.source[offset]
+      indent = line[: len(line) - len(line.lstrip())]
+      probe = exec_utils.probe_statement(
+          offset, state.ise, identifiers, indent
+      )
+      probes.append((offset, probe))
     state.probes = probes
 
     return probes
@@ -284,6 +495,8 @@ class Localiser(Agent):
     Returns:
         Object contents serialised into a string.
     """
+    if self.policy is not None:
+      return self._generate_probes_policy(state)
     return self._generate_probes_random(state)
 
   def pick_action(self, state, reward: int) -> None:
@@ -293,9 +506,15 @@ class Localiser(Agent):
         state: current state
         reward:  the reward for the previous state
     """
-    # TODO(etbarr):  add action selection
     # pp.pprint(f"state.codeview = {state.codeview}, reward = {reward},
     #          self.total_reward = {self.total_reward}")
+    if self.policy is not None:
+      # Each probe placed by the last action is credited for bracketing the
+      # illegal state, since the probes placed before it remain in place.
+      bracket = bracketing_offsets(self.env.observations)
+      self.policy.update(
+          np.array([float(offset in bracket) for offset, _ in state.probes])
+      )
     self.add_probes(state, self.generate_probes(state))
     self.total_reward += reward
     self.env.live = False
@@ -313,6 +532,21 @@ class Environment:
       max_steps: int
       descriptor: typeof(file descriptor)
       state: State
+      deterministic_replay: bool
+      replay_seed: int
+      entry_module: str
+      instrumented_program_dir: str
+      source_snapshot_name: private, read-only copy of the subject, which
+        backs the state's memory-mapped source
+      module_cache: dict[str, ModuleType]
+      compiler: IncrementalCompiler of the subject's instrumented versions
+      line_hits: Counter[int]
+      coverage_weighted: bool
+      trajectory_recorder: TrajectoryRecorder
+      episode: int
+      observations: [int x str] the last execution's observations
+      early_termination: bool
+      terminated_early: whether the last execution was stopped early
   """
 
   def __init__(
@@ -324,6 +558,12 @@ class Environment:
       burnin: int,
       max_steps: int,
       probe_output_filename: str,
+      deterministic_replay: bool = False,
+      replay_seed: int = 0,
+      entry_module: str | None = None,
+      coverage_weighted: bool = False,
+      trajectory_recorder: trajectory_utils.TrajectoryRecorder | None = None,
+      early_termination: bool = False,
   ):
     """Construct an environment instance.
 
@@ -334,6 +574,31 @@ class Environment:
     TODO(etbarr):  Add the argument, with a default, for the probe output
     file.
 
+    In deterministic replay mode, every execution pins the subject's sources
+    of nondeterminism to `replay_seed`, so the subject produces a single
+    output and burnin is unnecessary:  every step is checked against the
+    baseline output.  The baseline is executed twice to confirm this; if the
+    outputs differ, the environment warns and falls back to burnin.
+
+    When `buggy_program_name` names a directory, the subject is a package
+    whose `entry_module`, a path relative to that directory, is instrumented
+    and executed.  The entry module executes as `__main__` within the package
+    that holds it, whether that is the directory itself or a package inside
+    it, so its relative imports resolve.  The other modules in the package
+    are imported once per episode and cached in `module_cache`, so only the
+    instrumented module is recompiled at each step.
+
+    The baseline execution records line coverage in `line_hits`, which
+    restricts the state's insertion points to the lines the bug-triggering
+    run executes, weighting them by their hit counts if `coverage_weighted`.
+
+    If given a `trajectory_recorder`, the environment records each step
+    to it as part of a new episode.
+
+    With `early_termination`, an execution stops as soon as all probes have
+    fired, or the probe closest to the bug trap has observed the illegal
+    state; its output is then checked as a prefix of the baseline output.
+
     Args:
         args:  command line arguments
 
@@ -344,24 +609,87 @@ class Environment:
     self.buggy_program_output = set()
     self.descriptor = None
     self.steps = 0
+    self.observations = []
+    self.early_termination = early_termination
+    self.terminated_early = False
     self.max_steps = max_steps
+    self.trajectory_recorder = trajectory_recorder
+    if trajectory_recorder is not None:
+      self.episode = trajectory_recorder.new_episode()
+    else:
+      self.episode = None
+    self.deterministic_replay = deterministic_replay
+    self.replay_seed = replay_seed
     if burnin != 0:
-      self.max_burnin = math.ceil(burnin * self.max_steps)
+      self._burnin_steps = math.ceil(burnin * self.max_steps)
+    else:
+      self._burnin_steps = max_steps
+    if deterministic_replay:
+      self.max_burnin = 0
     else:
-      self.max_burnin = max_steps
-    file_extension = os.path.splitext(self.buggy_program_name)[1]
+      self.max_burnin = self._burnin_steps
+    self.entry_module = entry_module
+    self.instrumented_program_dir = None
+    self.module_cache = {}
+    is_package = os.path.isdir(self.buggy_program_name)
+    if is_package and entry_module is None:
+      err_template = "Error: package %s needs an entry module."
+      logging.error(err_template, self.buggy_program_name)
+      raise ValueError(err_template, self.buggy_program_name)
+    if is_package:
+      subject_name = os.path.join(self.buggy_program_name, entry_module)
+    else:
+      subject_name = self.buggy_program_name
+    file_extension = os.path.splitext(subject_name)[1]
     # TODO(etbarr) bl/284330538 fix extension kludge
     if file_extension != ".py":
       err_template = "Error: %s is not a Python script."
-      logging.error(err_template, self.buggy_program_name)
-      raise ValueError(err_template, self.buggy_program_name)
+      logging.error(err_template, subject_name)
+      raise ValueError(err_template, subject_name)
     collision_avoiding_prefix = "__"
     try:
-      self.instrumented_program_name = os.path.join(
-          tempfile.gettempdir(),
-          collision_avoiding_prefix + os.path.basename(self.buggy_program_name)
+      if is_package:
+        self.instrumented_program_dir = tempfile.mkdtemp(
+            prefix=collision_avoiding_prefix
+        )
+        package_dir = self.instrumented_program_dir
+        # A subject that is itself a package keeps its name, so that its
+        # modules import from the directory above it.
+        package_name = os.path.basename(os.path.normpath(buggy_program_name))
+        if os.path.exists(os.path.join(buggy_program_name, "__init__.py")):
+          package_dir = os.path.join(package_dir, package_name)
+        shutil.copytree(
+            self.buggy_program_name,
+            package_dir,
+            ignore=shutil.ignore_patterns("__pycache__"),
+            dirs_exist_ok=True,
+        )
+        self.instrumented_program_name = os.path.join(
+            package_dir, entry_module
+        )
+      else:
+        # A directory per environment keeps concurrent episodes apart.
+        self.instrumented_program_name = os.path.join(
+            tempfile.mkdtemp(prefix=collision_avoiding_prefix),
+            collision_avoiding_prefix
+            + os.path.basename(self.buggy_program_name),
+        )
+        shutil.copyfile(
+            self.buggy_program_name, self.instrumented_program_name
+        )
+      # The source is memory-mapped from a private, read-only snapshot, as
+      # the subject may change under a long run and its instrumented copy is
+      # rewritten at every step; a mapped file that shrinks crashes readers.
+      self.source_snapshot_name = os.path.join(
+          os.path.dirname(self.instrumented_program_name)
+          if self.instrumented_program_dir is None
+          else self.instrumented_program_dir,
+          collision_avoiding_prefix + "source__",
+      )
+      shutil.copyfile(
+          self.instrumented_program_name, self.source_snapshot_name
       )
-      shutil.copyfile(self.buggy_program_name, self.instrumented_program_name)
+      os.chmod(self.source_snapshot_name, 0o444)
     except IOError as e:
       raise IOError(
           "Unable to copy subject program to /tmp for instrumentation."
@@ -373,14 +701,74 @@ class Environment:
     except IOError as e:
       logging.error("Error: Unable to open file '%s'.", self.buggy_program_name)
       raise e
-    self.state = State(self.descriptor, illegal_state_expr, bug_trap)
+    self.state = State(
+        self.descriptor,
+        illegal_state_expr,
+        bug_trap,
+        source=source_utils.load_source(self.source_snapshot_name),
+    )
+    self.compiler = exec_utils.IncrementalCompiler(self.state.source)
+
+    self.line_hits = collections.Counter()
+    self.coverage_weighted = coverage_weighted
+    self._execute_baseline()
+
+  def _execute_baseline(self) -> None:
+    """Execute the uninstrumented subject to record its baseline."""
+    outputs = [self.execute_subject(line_hits=self.line_hits)]
+    if self.deterministic_replay:
+      outputs.append(self.execute_subject())
+    self._record_baseline(outputs)
+
+  def _record_baseline(self, outputs: List[str]) -> None:
+    """Record the baseline outputs and coverage of the subject.
+
+    Under deterministic replay, the baseline is executed twice; if the two
+    outputs differ, replay has not made the subject deterministic and the
+    environment falls back to burnin.
+
+    Args:
+      outputs: the outputs of the baseline executions
+    """
+    self.buggy_program_output.update(map(strip_probe_output, outputs))
+    if len(self.buggy_program_output) > 1 and self.deterministic_replay:
+      logging.warning(
+          "Warning: %s is nondeterministic despite replay; using burnin.",
+          self.buggy_program_name,
+      )
+      self.max_burnin = self._burnin_steps
+    self._prune_insertion_points(self.coverage_weighted)
 
-    self.buggy_program_output.add(self.execute_subject())
+  def _prune_insertion_points(self, coverage_weighted: bool) -> None:
+    """Restrict the state's insertion points to lines the baseline executed.
+
+    Args:
+      coverage_weighted: whether to weight insertion points by hit count
+    """
+    insertion_points = [
+        line
+        for line in self.state.get_statement_lines()
+        if self.line_hits[line] > 0
+    ]
+    if not insertion_points:
+      logging.warning(
+          "The baseline execution reached no insertion points in '%s'.",
+          self.buggy_program_name,
+      )
+      return
+    self.state.insertion_points = insertion_points
+    if coverage_weighted:
+      self.state.insertion_weights = np.array(
+          [self.line_hits[line] for line in insertion_points], dtype=float
+      )
 
   # TODO(etbarr) Gather and pass a subject's parameters to it.
-  def execute_subject(self) -> str:
+  def execute_subject(self, line_hits: Counter[int] | None = None) -> str:
     """Execute an instrumented version of the buggy program.
 
+    Args:
+      line_hits: if given, counter to which to add the subject's line coverage
+
     Returns:
       Returns the subject's output, concatenating standard and error.
 
@@ -388,25 +776,51 @@ class Environment:
       CallProcessError if subprocess.run fails.
     """
     assert self.descriptor is not None
-    self.descriptor.seek(0)
+    # Only the chunks of the subject whose probes changed are recompiled.
+    compiled_chunks = self.compiler.compile(self.state.overlay)
 
-    python_source = self.descriptor.read()
     try:
-      compiled_source = compile(
-          python_source, "<code_to_instrument>", mode="exec"
+      exec_globals = exec_utils.subject_globals(
+          self.instrumented_program_name, self.instrumented_program_dir
       )
-    except SyntaxError as e:
-      raise e
-
-    try:
-      exec_globals = {}
       exec_locals = None
-      buffer = io.StringIO()
+      if self.early_termination:
+        buffer = exec_utils.ProbeWatcher(
+            self.state.ise, self.state.overlay.offsets, self.state.bug_trap
+        )
+      else:
+        buffer = io.StringIO()
+      if self.deterministic_replay:
+        pinning = exec_utils.pinned_nondeterminism(self.replay_seed)
+      else:
+        pinning = contextlib.nullcontext()
+      if self.instrumented_program_dir is not None:
+        overlay = exec_utils.module_overlay(
+            self.instrumented_program_dir,
+            self.module_cache,
+            excluded=exec_globals["__spec__"].name,
+        )
+      else:
+        overlay = contextlib.nullcontext()
+      if line_hits is not None:
+        coverage = exec_utils.line_coverage(
+            exec_utils.SUBJECT_FILENAME, line_hits
+        )
+      else:
+        coverage = contextlib.nullcontext()
       with (
+          pinning,
+          overlay,
+          coverage,
           contextlib.redirect_stdout(buffer),
           contextlib.redirect_stderr(buffer),
       ):
-        exec(compiled_source, exec_globals, exec_locals)  # pylint:disable=exec-used
+        try:
+          for compiled_chunk in compiled_chunks:
+            exec(compiled_chunk, exec_globals, exec_locals)  # pylint:disable=exec-used
+        except exec_utils.EarlyTermination:
+          pass
+      self.terminated_early = self.early_termination and buffer.terminated
       return buffer.getvalue()
     except Exception as e:
       logging.error("Error: %s", e)
@@ -415,11 +829,15 @@ class Environment:
   def reward(self) -> int:
     """Return reward for current state.
 
+    The last execution earns a reward when its probes observed the illegal
+    state expression both false and true, bracketing where the illegal
+    state arises.
+
     Returns:
         reward
     """
-    # TODO(etbarr)
-    return 1
+    values = {value for _, value in self.observations}
+    return int({"False", "True"} <= values)
 
   def terminate(self) -> bool:
     """Determine whether to terminate simulation.
@@ -446,23 +864,89 @@ class Environment:
       case _:
         pass
     self.steps += 1
+    start = time.perf_counter()
+    output = self.execute_subject()
+    self.observations = parse_observations(output, self.state.ise)
+    self._record_step(output, time.perf_counter() - start)
+    self._check_output(output)
 
-    stdouterr = self.execute_subject()
+  def _record_step(self, output: str, execution_seconds: float) -> None:
+    """Record the current step to the trajectory recorder, if any.
+
+    Args:
+        output:  the output of the instrumented subject
+        execution_seconds:  time taken to execute the subject
+    """
+    if self.trajectory_recorder is None:
+      return
+    observations = self.observations
+    digest = hashlib.blake2b(output.encode("utf-8"), digest_size=8).digest()
+    self.trajectory_recorder.record(
+        episode=self.episode,
+        step=self.steps,
+        probe_offsets=self.state.overlay.offsets,
+        observation_offsets=[offset for offset, _ in observations],
+        observation_values=[
+            _OBSERVATION_CODES.get(value, -1) for _, value in observations
+        ],
+        output_digest=int.from_bytes(digest, "little"),
+        execution_seconds=execution_seconds,
+        reward=self.reward(),
+    )
+
+  def _check_output(self, output: str) -> None:
+    """Check the output of an instrumented execution against the baseline.
+
+    Args:
+        output:  the output of the instrumented subject
+
+    Raises:
+        AssertionError if the subject's own output has changed.
+    """
+    stdouterr = strip_probe_output(output)
     # Check that adding probes has not changed the buggy program's semantics
     # This check --- for whether we've seen the output during burnin ---
-    # is an instance of the coupon collector's problem.
+    # is an instance of the coupon collector's problem, unless deterministic
+    # replay pins the subject to a single output.  An execution stopped early
+    # produces only a prefix of some output.
     if self.steps > self.max_burnin:
       error_message = (
           "Error: probe insertion or execution changed program semantics."
       )
-      if stdouterr not in self.buggy_program_output:
+      if self.terminated_early:
+        seen = any(
+            baseline.startswith(stdouterr)
+            for baseline in self.buggy_program_output
+        )
+      else:
+        seen = stdouterr in self.buggy_program_output
+      if not seen:
         logging.exception(error_message)
         raise AssertionError(error_message)
 
-    self.buggy_program_output.add(stdouterr)
+    if not self.terminated_early:
+      self.buggy_program_output.add(stdouterr)
     # TODO(etbarr) Create and return a new state instance
     # Probe's write their output to a fresh file
 
+  def cleanup(self) -> None:
+    """Close and remove the instrumented copy of the buggy program."""
+    if self.descriptor is not None:
+      self.descriptor.close()
+    try:
+      if self.instrumented_program_dir is not None:
+        shutil.rmtree(self.instrumented_program_dir)
+      else:
+        os.remove(self.instrumented_program_name)
+        os.remove(self.source_snapshot_name)
+        os.rmdir(os.path.dirname(self.instrumented_program_name))
+    except IOError as e:
+      logging.error(
+          "Error: Unable to remove temp file '%s'.",
+          self.instrumented_program_name,
+      )
+      raise e
+
   def to_string(self) -> str:
     """Convert object into string representation.
 
@@ -470,3 +954,103 @@ class Environment:
         Object contents serialised into a string.
     """
     raise NotImplementedError
+
+
+class AsyncEnvironment(Environment):
+  """Represent the RL environment for use from asyncio code.
+
+  Steps execute the instrumented subject in a worker subprocess, whose output
+  is captured through its own pipe rather than by redirecting the process-wide
+  `sys.stdout`, so many environments can step concurrently on one event loop.
+  The baseline executes in a worker too, under the same hash seed as the
+  steps, once `start` is awaited, which must happen before the first step.
+  """
+
+  def _execute_baseline(self) -> None:
+    """Defer the baseline execution to `start`."""
+
+  async def start(self) -> None:
+    """Execute the subject's baseline in a worker subprocess."""
+    outputs = [await self.execute_subject_async(line_hits=self.line_hits)]
+    if self.deterministic_replay:
+      outputs.append(await self.execute_subject_async())
+    self._record_baseline(outputs)
+
+  async def execute_subject_async(
+      self, line_hits: Counter[int] | None = None
+  ) -> str:
+    """Execute an instrumented version of the buggy program in a subprocess.
+
+    Args:
+      line_hits: if given, counter to which to add the subject's line coverage
+
+    Returns:
+      Returns the subject's output, concatenating standard and error.
+
+    Raises:
+      CalledProcessError if the subject exits with a nonzero status.
+    """
+    command = [
+        sys.executable,
+        "-u",
+        "-c",
+        _WORKER_BOOTSTRAP,
+        self.instrumented_program_name,
+    ]
+    if line_hits is not None:
+      coverage_file, coverage_filename = tempfile.mkstemp(suffix=".coverage")
+      os.close(coverage_file)
+      command += ["--coverage_file", coverage_filename]
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [_PACKAGE_ROOT, env.get("PYTHONPATH")])
+    )
+    if self.instrumented_program_dir is not None:
+      command += ["--directory", self.instrumented_program_dir]
+    if self.deterministic_replay:
+      command += ["--replay_seed", str(self.replay_seed)]
+      env["PYTHONHASHSEED"] = str(self.replay_seed)
+    if self.early_termination:
+      offsets = ",".join(map(str, self.state.overlay.offsets))
+      command += [
+          f"--early_termination_ise={self.state.ise}",
+          f"--probe_offsets={offsets}",
+          f"--bug_trap={self.state.bug_trap}",
+      ]
+    # Imported here, where the caller's event loop has already loaded it, to
+    # keep asyncio off the import path of synchronous users.
+    import asyncio  # pylint:disable=g-import-not-at-top
+
+    process = await asyncio.create_subprocess_exec(
+        *command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        env=env,
+    )
+    stdout, _ = await process.communicate()
+    output = stdout.decode("utf-8")
+    if line_hits is not None:
+      line_hits.update(exec_utils.read_line_hits(coverage_filename))
+      os.remove(coverage_filename)
+    self.terminated_early = (
+        self.early_termination
+        and process.returncode == exec_utils.EARLY_TERMINATION_STATUS
+    )
+    if process.returncode != 0 and not self.terminated_early:
+      logging.error("Error: subject exited with status %d.", process.returncode)
+      raise subprocess.CalledProcessError(process.returncode, command, output)
+    return output
+
+  async def step(self, action) -> None:
+    """Asynchronously update simulation given the selected action.
+
+    Args:
+        action:  action selected by agent
+    """
+    del action  # Unused, as in `update`.
+    self.steps += 1
+    start = time.perf_counter()
+    output = await self.execute_subject_async()
+    self.observations = parse_observations(output, self.state.ise)
+    self._record_step(output, time.perf_counter() - start)
+    self._check_output(output)
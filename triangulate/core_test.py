@@ -14,18 +14,51 @@
 
 """Tests for core."""
 
+import asyncio
+import contextlib
+import csv
 import os
+import subprocess
+import sys
+import tempfile
+from unittest import mock
 
 from absl.testing import absltest
 from absl.testing import parameterized
+import numpy as np
 from triangulate import core
+from triangulate import exec_utils
+from triangulate import policy_utils
+from triangulate import source_utils
+from triangulate import trajectory_utils
 
 TESTDATA_DIRECTORY = os.path.join(
     absltest.get_default_test_srcdir(),
     "triangulate/testdata",
 )
 TEST_PROGRAM_PATH = os.path.join(TESTDATA_DIRECTORY, "quoter.py")
-TEST_PROGRAM_ASSERT_LINE_NUMBER = 40
+TEST_PROGRAM_ASSERT_LINE_NUMBER = 54
+NONDETERMINISTIC_PROGRAM_PATH = os.path.join(TESTDATA_DIRECTORY, "dice.py")
+NONDETERMINISTIC_PROGRAM_ASSERT_LINE_NUMBER = 25
+TEST_PACKAGE_PATH = os.path.join(TESTDATA_DIRECTORY, "quoter_package")
+TEST_PACKAGE_ASSERT_LINE_NUMBER = 26
+RELATIVE_IMPORT_PACKAGE_PATH = os.path.join(
+    TESTDATA_DIRECTORY, "counter_package"
+)
+RELATIVE_IMPORT_PACKAGE_ASSERT_LINE_NUMBER = 21
+PARTIALLY_EXECUTED_PROGRAM_PATH = os.path.join(
+    TESTDATA_DIRECTORY, "calculator.py"
+)
+PARTIALLY_EXECUTED_PROGRAM_ASSERT_LINE_NUMBER = 26
+
+
+def _make_environment(run_async: bool, **kwargs) -> core.Environment:
+  """Return a started environment that steps synchronously or not."""
+  if not run_async:
+    return core.Environment(**kwargs)
+  env = core.AsyncEnvironment(**kwargs)
+  asyncio.run(env.start())
+  return env
 
 
 class EnvironmentTest(parameterized.TestCase):
@@ -83,6 +116,280 @@ Today's inspirational quote:
     env.update(action=action)
     self.assertEqual(output, expected_output)
 
+  def test_deterministic_replay(self):
+    env = core.Environment(
+        buggy_program_name=NONDETERMINISTIC_PROGRAM_PATH,
+        illegal_state_expr='roll > 6',
+        bug_triggering_input='',
+        bug_trap=NONDETERMINISTIC_PROGRAM_ASSERT_LINE_NUMBER,
+        burnin=0,
+        max_steps=10,
+        probe_output_filename='',
+        deterministic_replay=True,
+    )
+    self.assertEqual(env.max_burnin, 0)
+    self.assertEqual(env.execute_subject(), env.execute_subject())
+    while not env.terminate():
+      env.update(action='<placeholder>')
+    self.assertLen(env.buggy_program_output, 1)
+
+  def test_source_survives_changes_to_the_subject(self):
+    subject_dir = self.enter_context(tempfile.TemporaryDirectory())
+    subject = os.path.join(subject_dir, 'quoter.py')
+    with open(TEST_PROGRAM_PATH) as f:
+      original = f.read()
+    with open(subject, 'w') as f:
+      f.write(original)
+    env = core.Environment(
+        buggy_program_name=subject,
+        illegal_state_expr='1 == 1',
+        bug_triggering_input='42',
+        bug_trap=TEST_PROGRAM_ASSERT_LINE_NUMBER,
+        burnin=0,
+        max_steps=10,
+        probe_output_filename='',
+    )
+    # Truncating a memory-mapped file would fault any later read of it.
+    with open(subject, 'w'):
+      pass
+    env.update(action='<placeholder>')
+    self.assertEqual(env.state.source.text(), original)
+    snapshot = env.source_snapshot_name
+    env.cleanup()
+    self.assertFalse(os.path.exists(snapshot))
+
+  def test_nondeterministic_replay_falls_back_to_burnin(self):
+    # Without pinning, dice.py is nondeterministic despite replay.
+    with mock.patch.object(
+        exec_utils, 'pinned_nondeterminism', return_value=contextlib.nullcontext()
+    ):
+      env = core.Environment(
+          buggy_program_name=NONDETERMINISTIC_PROGRAM_PATH,
+          illegal_state_expr='roll > 6',
+          bug_triggering_input='',
+          bug_trap=NONDETERMINISTIC_PROGRAM_ASSERT_LINE_NUMBER,
+          burnin=0.5,
+          max_steps=10,
+          probe_output_filename='',
+          deterministic_replay=True,
+      )
+    self.assertEqual(env.max_burnin, 5)
+    self.assertLen(env.buggy_program_output, 2)
+
+  def test_package_subject_caches_sibling_modules(self):
+    env = core.Environment(
+        buggy_program_name=TEST_PACKAGE_PATH,
+        illegal_state_expr='1 == 1',
+        bug_triggering_input='',
+        bug_trap=TEST_PACKAGE_ASSERT_LINE_NUMBER,
+        burnin=0,
+        max_steps=10,
+        probe_output_filename='',
+        entry_module='main.py',
+    )
+    quote_book = env.module_cache['quote_book']
+    self.assertNotIn('quote_book', sys.modules)
+    output = env.execute_subject()
+    self.assertIs(env.module_cache['quote_book'], quote_book)
+    self.assertEqual(
+        output,
+        '''\
+Today's inspirational quote:
+"You miss 100% of the shots you don't take." - Wayne Gretzky
+''',
+    )
+    env.cleanup()
+    self.assertFalse(os.path.exists(env.instrumented_program_dir))
+
+  @parameterized.product(
+      (
+          dict(package='', entry_module='tally/main.py'),
+          dict(package='tally', entry_module='main.py'),
+      ),
+      run_async=(False, True),
+  )
+  def test_package_subject_imports_relatively(
+      self, package: str, entry_module: str, run_async: bool
+  ):
+    env = _make_environment(
+        run_async,
+        buggy_program_name=os.path.join(RELATIVE_IMPORT_PACKAGE_PATH, package),
+        illegal_state_expr='total > 3',
+        bug_triggering_input='',
+        bug_trap=RELATIVE_IMPORT_PACKAGE_ASSERT_LINE_NUMBER,
+        burnin=0,
+        max_steps=10,
+        probe_output_filename='',
+        entry_module=entry_module,
+    )
+    if run_async:
+      output = asyncio.run(env.execute_subject_async())
+    else:
+      output = env.execute_subject()
+    env.cleanup()
+    self.assertEqual(output, 'Counted 4 marks in package tally\n')
+
+  @parameterized.parameters(False, True)
+  def test_package_modules_shadow_host_modules(self, run_async: bool):
+    directory = self.enter_context(tempfile.TemporaryDirectory())
+    with open(os.path.join(directory, 'csv.py'), 'w') as f:
+      f.write('ORIGIN = "subject"\n')
+    with open(os.path.join(directory, 'main.py'), 'w') as f:
+      f.write(
+          'import csv\nx = 1\nassert x == 1\n'
+          'print(getattr(csv, "ORIGIN", "host"), "csv")\n'
+      )
+    env = _make_environment(
+        run_async,
+        buggy_program_name=directory,
+        illegal_state_expr='x != 1',
+        bug_triggering_input='',
+        bug_trap=2,
+        burnin=0,
+        max_steps=10,
+        probe_output_filename='',
+        entry_module='main.py',
+    )
+    env.cleanup()
+    self.assertEqual(env.buggy_program_output, {'subject csv\n'})
+    self.assertIs(sys.modules['csv'], csv)
+
+  @parameterized.parameters(False, True)
+  def test_early_termination(self, run_async: bool):
+    env = _make_environment(
+        run_async,
+        buggy_program_name=PARTIALLY_EXECUTED_PROGRAM_PATH,
+        illegal_state_expr='total != 5',
+        bug_triggering_input='',
+        bug_trap=PARTIALLY_EXECUTED_PROGRAM_ASSERT_LINE_NUMBER,
+        burnin=0,
+        max_steps=2,
+        probe_output_filename='',
+        deterministic_replay=True,
+        early_termination=True,
+    )
+    localiser = core.Localiser(env)
+    localiser.add_probes(env.state, localiser._make_probes(env.state, [26, 27]))
+    if run_async:
+      asyncio.run(env.step(action='<placeholder>'))
+    else:
+      env.update(action='<placeholder>')
+    self.assertTrue(env.terminated_early)
+    self.assertEqual(
+        [offset for offset, _ in env.observations],
+        [25, 26],
+    )
+    # The subject stopped before printing its total.
+    self.assertEqual(env.buggy_program_output, {'Total: 5\n'})
+
+  def test_records_trajectory(self):
+    directory = self.enter_context(tempfile.TemporaryDirectory())
+    with trajectory_utils.TrajectoryRecorder(directory) as recorder:
+      env = core.Environment(
+          buggy_program_name=PARTIALLY_EXECUTED_PROGRAM_PATH,
+          illegal_state_expr='total != 5',
+          bug_triggering_input='',
+          bug_trap=PARTIALLY_EXECUTED_PROGRAM_ASSERT_LINE_NUMBER,
+          burnin=0,
+          max_steps=3,
+          probe_output_filename='',
+          deterministic_replay=True,
+          trajectory_recorder=recorder,
+      )
+      localiser = core.Localiser(env)
+      while not env.terminate():
+        localiser.add_probes(env.state, localiser.generate_probes(env.state))
+        env.update(action='<placeholder>')
+
+    (shard,) = trajectory_utils.read_trajectories(directory)
+    np.testing.assert_array_equal(shard['step'], [1, 2, 3])
+    np.testing.assert_array_equal(shard['episode'], [env.episode] * 3)
+    self.assertContainsSubset(
+        shard['observation_offsets'], env.state.overlay.offsets
+    )
+    # Probes before the assignment to `total` observe it to be undefined.
+    self.assertContainsSubset(shard['observation_values'], [-1, 0])
+
+
+class AsyncEnvironmentTest(parameterized.TestCase):
+
+  def test_concurrent_steps_match_in_process_execution(self):
+    envs = [
+        core.AsyncEnvironment(
+            buggy_program_name=NONDETERMINISTIC_PROGRAM_PATH,
+            illegal_state_expr='roll > 6',
+            bug_triggering_input='',
+            bug_trap=NONDETERMINISTIC_PROGRAM_ASSERT_LINE_NUMBER,
+            burnin=0,
+            max_steps=2,
+            probe_output_filename='',
+            deterministic_replay=True,
+            replay_seed=seed,
+        )
+        for seed in range(3)
+    ]
+
+    async def run_episode(env):
+      await env.start()
+      while not env.terminate():
+        await env.step(action='<placeholder>')
+      return await env.execute_subject_async()
+
+    async def run_episodes():
+      return await asyncio.gather(*(run_episode(env) for env in envs))
+
+    outputs = asyncio.run(run_episodes())
+    for env, output in zip(envs, outputs):
+      self.assertEqual(env.steps, env.max_steps)
+      self.assertEqual(output, env.execute_subject())
+
+  def test_failing_subject_raises(self):
+    env = core.AsyncEnvironment(
+        buggy_program_name=TEST_PROGRAM_PATH,
+        illegal_state_expr='1 == 1',
+        bug_triggering_input='',
+        bug_trap=TEST_PROGRAM_ASSERT_LINE_NUMBER,
+        burnin=0,
+        max_steps=2,
+        probe_output_filename='',
+    )
+    asyncio.run(env.start())
+    env.descriptor.seek(0, os.SEEK_END)
+    env.descriptor.write('raise RuntimeError("bug")\n')
+    env.descriptor.flush()
+    with self.assertRaises(subprocess.CalledProcessError):
+      asyncio.run(env.step(action='<placeholder>'))
+
+
+  def test_baseline_shares_the_steps_hash_seed(self):
+    directory = self.enter_context(tempfile.TemporaryDirectory())
+    subject = os.path.join(directory, 'hashing.py')
+    with open(subject, 'w') as f:
+      f.write('digest = hash("triangulate")\nassert digest\nprint(digest)\n')
+    env = core.AsyncEnvironment(
+        buggy_program_name=subject,
+        illegal_state_expr='digest < 0',
+        bug_triggering_input='',
+        bug_trap=1,
+        burnin=0,
+        max_steps=2,
+        probe_output_filename='',
+        deterministic_replay=True,
+        replay_seed=1,
+    )
+    self.assertEmpty(env.buggy_program_output)
+
+    async def run_episode():
+      await env.start()
+      while not env.terminate():
+        await env.step(action='<placeholder>')
+
+    asyncio.run(run_episode())
+    self.assertEqual(env.max_burnin, 0)
+    self.assertLen(env.buggy_program_output, 1)
+    self.assertGreater(sum(env.line_hits.values()), 0)
+    env.cleanup()
+
 
 class LocaliserTest(parameterized.TestCase):
 
@@ -118,6 +425,107 @@ class LocaliserTest(parameterized.TestCase):
     localiser = core.Localiser(env)
     localiser._generate_probes_random(env.state)
 
+  @parameterized.parameters(False, True)
+  def test_probes_only_executed_lines(self, coverage_weighted: bool):
+    env = core.Environment(
+        buggy_program_name=PARTIALLY_EXECUTED_PROGRAM_PATH,
+        illegal_state_expr='total != 5',
+        bug_triggering_input='',
+        bug_trap=PARTIALLY_EXECUTED_PROGRAM_ASSERT_LINE_NUMBER,
+        burnin=0,
+        max_steps=10,
+        probe_output_filename='',
+        deterministic_replay=True,
+        coverage_weighted=coverage_weighted,
+    )
+    self.assertEqual(env.state.insertion_points, [18, 19, 22, 26, 27, 29])
+    localiser = core.Localiser(env)
+    while not env.terminate():
+      probes = localiser.generate_probes(env.state)
+      for offset, _ in probes:
+        self.assertIn(offset + 1, env.state.insertion_points)
+      localiser.add_probes(env.state, probes)
+      env.update(action='<placeholder>')
+
+  def test_probes_only_lines_whose_bindings_may_differ(self):
+    env = core.Environment(
+        buggy_program_name=PARTIALLY_EXECUTED_PROGRAM_PATH,
+        illegal_state_expr='total != 5',
+        bug_triggering_input='',
+        bug_trap=PARTIALLY_EXECUTED_PROGRAM_ASSERT_LINE_NUMBER,
+        burnin=0,
+        max_steps=10,
+        probe_output_filename='',
+    )
+    localiser = core.Localiser(env)
+    # Neither definition rebinds `total`, which the call on line 26 may.
+    probes = localiser._make_probes(env.state, [27, 26, 22, 18, 18])
+    self.assertEqual([offset for offset, _ in probes], [17, 26])
+    localiser.add_probes(env.state, probes)
+    localiser.add_probes(env.state, probes)
+    self.assertLen(env.state.overlay, 2)
+    # Later steps skip lines whose bindings the overlay already probes.
+    self.assertEmpty(localiser._make_probes(env.state, [22, 26]))
+    env.descriptor.seek(0)
+    self.assertEqual(
+        env.state.get_codeview(), env.descriptor.read().splitlines(True)
+    )
+    probe_lines = sum(probe.count('\n') for _, probe in probes)
+    self.assertLen(
+        env.state.get_codeview(), len(env.state.source) + probe_lines
+    )
+
+  def test_bracketing_offsets(self):
+    self.assertEqual(
+        core.bracketing_offsets(
+            [(3, 'undefined'), (7, 'False'), (9, 'True'), (12, 'True')]
+        ),
+        [7, 9],
+    )
+    self.assertEqual(core.bracketing_offsets([(9, 'True')]), [9])
+    self.assertEmpty(core.bracketing_offsets([(7, 'False')]))
+
+  @parameterized.parameters(False, True)
+  def test_policy_places_probes(self, coverage_weighted: bool):
+    env = core.Environment(
+        buggy_program_name=PARTIALLY_EXECUTED_PROGRAM_PATH,
+        illegal_state_expr='total != 5',
+        bug_triggering_input='',
+        bug_trap=PARTIALLY_EXECUTED_PROGRAM_ASSERT_LINE_NUMBER,
+        burnin=0,
+        max_steps=5,
+        probe_output_filename='',
+        deterministic_replay=True,
+        coverage_weighted=coverage_weighted,
+    )
+    policy = policy_utils.LinearBanditPolicy()
+    localiser = core.Localiser(env, policy=policy)
+    text = self.enter_context(
+        mock.patch.object(
+            source_utils.SourceText,
+            'text',
+            autospec=True,
+            side_effect=source_utils.SourceText.text,
+        )
+    )
+    while not env.terminate():
+      localiser.pick_action(env.state, env.reward())
+      env.update(action='<placeholder>')
+      self.assertEqual(env.reward(), 0)
+    # The whole source is decoded once, for its binding segments, not per step.
+    self.assertEqual(text.call_count, 1)
+    self.assertNotEmpty(env.state.overlay)
+    for offset in env.state.overlay.offsets:
+      self.assertIn(offset + 1, env.state.insertion_points)
+    # No two probes see the same bindings of the illegal state expression.
+    segments = env.state.get_binding_segments()
+    probed_segments = [
+        segments.get(offset + 1, -offset - 1)
+        for offset in env.state.overlay.offsets
+    ]
+    self.assertLen(set(probed_segments), len(probed_segments))
+    self.assertGreater(np.trace(policy.precision), policy_utils.NUM_FEATURES)
+
 
 if __name__ == "__main__":
   absltest.main()
@@ -0,0 +1,625 @@
+# Copyright 2023 The triangulate Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Utilities for executing subject programs."""
+
+import argparse
+import ast
+import bisect
+import collections
+import contextlib
+import datetime
+import functools
+import importlib.machinery
+import io
+import itertools
+import os
+import random
+import re
+import sys
+import time
+import types
+from typing import Any, Counter, Dict, Iterable, Iterator, List, Sequence
+
+# The filename with which the instrumented subject is compiled.
+SUBJECT_FILENAME = "<code_to_instrument>"
+# Every line a probe prints starts with this prefix.
+PROBE_PREFIX = "Illegal state predicate"
+# The exit status of a worker process that stopped its subject early.
+EARLY_TERMINATION_STATUS = 86
+# Midnight, 1 January 2023 UTC: the instant at which replayed subjects run.
+FROZEN_TIME = 1672531200.0
+# The clocks of the `time` module that replay pins.
+_PINNED_CLOCKS = (
+    "time",
+    "time_ns",
+    "monotonic",
+    "monotonic_ns",
+    "perf_counter",
+    "perf_counter_ns",
+    "process_time",
+    "process_time_ns",
+)
+# The amount by which pinned monotonic clocks advance at every reading.
+CLOCK_TICK = 0.001
+
+
+def _ticking_clock(tick: float):
+  """Return a clock, and its nanosecond twin, that advance at every reading."""
+  readings = itertools.count(1)
+
+  def clock() -> float:
+    return next(readings) * tick
+
+  def clock_ns() -> int:
+    return int(clock() * 1e9)
+
+  return clock, clock_ns
+
+
+def _frozen_datetime_types(frozen_time: float):
+  """Return `datetime.date` and `datetime.datetime` frozen at `frozen_time`."""
+
+  class FrozenDate(datetime.date):
+
+    @classmethod
+    def today(cls):
+      return cls.fromtimestamp(frozen_time)
+
+  class FrozenDatetime(datetime.datetime):
+
+    @classmethod
+    def now(cls, tz=None):
+      return cls.fromtimestamp(frozen_time, tz)
+
+    @classmethod
+    def utcnow(cls):
+      now = cls.fromtimestamp(frozen_time, datetime.timezone.utc)
+      return now.replace(tzinfo=None)
+
+    @classmethod
+    def today(cls):
+      return cls.fromtimestamp(frozen_time)
+
+  return FrozenDate, FrozenDatetime
+
+
+@contextlib.contextmanager
+def pinned_nondeterminism(
+    seed: int, frozen_time: float = FROZEN_TIME
+) -> Iterator[None]:
+  """Pin the common sources of nondeterminism while a subject executes.
+
+  Within the context:
+  - the `random` module is seeded with `seed`, and `random.Random` instances
+    seeded without a seed draw theirs from a generator seeded with `seed`;
+  - `os.urandom`, and so `random.SystemRandom` and `secrets`, return bytes
+    drawn from a generator seeded with `seed`;
+  - `time.time`, `time.time_ns` and the `now` and `today` of the `datetime`
+    module's `date` and `datetime` report `frozen_time`;
+  - `time.monotonic`, `time.perf_counter` and `time.process_time` start at
+    zero and advance by `CLOCK_TICK` at every reading, so that timeouts
+    still expire;
+  - if the subject has already imported NumPy, its legacy global generator
+    is seeded with `seed`.
+  Everything is restored on exit, so repeated executions under the same seed
+  produce the same output.  Subjects that import `date` or `datetime` from
+  the `datetime` module before the context is entered keep the real ones.
+
+  String hashing is fixed for the lifetime of the interpreter, so it is
+  already constant across executions within one process; subjects run in a
+  fresh interpreter must be given `PYTHONHASHSEED` to pin it.
+
+  Args:
+    seed: Seed from which all pinned sources derive their values
+    frozen_time: Seconds since the epoch reported by `time.time`
+
+  Yields:
+    None
+  """
+  random_state = random.getstate()
+  saved_random_seed = random.Random.seed
+  saved_random_urandom = random._urandom  # pylint:disable=protected-access
+  saved_urandom = os.urandom
+  saved_clocks = {name: getattr(time, name) for name in _PINNED_CLOCKS}
+  saved_date = datetime.date
+  saved_datetime = datetime.datetime
+  numpy_random = getattr(sys.modules.get("numpy"), "random", None)
+  numpy_state = numpy_random.get_state() if numpy_random else None
+
+  urandom_rng = random.Random(seed)
+  seed_rng = random.Random(seed + 1)
+
+  def seed_random(self, a=None, version=2):
+    if a is None:
+      a = seed_rng.getrandbits(64)
+    saved_random_seed(self, a, version)
+
+  random.seed(seed)
+  random.Random.seed = seed_random
+  os.urandom = urandom_rng.randbytes
+  random._urandom = urandom_rng.randbytes  # pylint:disable=protected-access
+  time.time = lambda: frozen_time
+  time.time_ns = lambda: int(frozen_time * 1e9)
+  for name in ("monotonic", "perf_counter", "process_time"):
+    clock, clock_ns = _ticking_clock(CLOCK_TICK)
+    setattr(time, name, clock)
+    setattr(time, name + "_ns", clock_ns)
+  datetime.date, datetime.datetime = _frozen_datetime_types(frozen_time)
+  if numpy_random:
+    numpy_random.seed(seed)
+  try:
+    yield
+  finally:
+    for name, clock in saved_clocks.items():
+      setattr(time, name, clock)
+    datetime.date = saved_date
+    datetime.datetime = saved_datetime
+    os.urandom = saved_urandom
+    random._urandom = saved_random_urandom  # pylint:disable=protected-access
+    random.Random.seed = saved_random_seed
+    random.setstate(random_state)
+    if numpy_random:
+      numpy_random.set_state(numpy_state)
+
+
+@contextlib.contextmanager
+def module_overlay(
+    directory: str,
+    cache: Dict[str, types.ModuleType],
+    excluded: str | None = None,
+) -> Iterator[None]:
+  """Import a subject's sibling modules from a per-episode module cache.
+
+  Within the context, `directory` heads `sys.path` and the modules in `cache`
+  shadow any entries of `sys.modules` with the same name, so the subject's
+  imports reuse them instead of re-importing them.  Modules the host has
+  imported under the name of a module or package in `directory`, e.g. a
+  subject's `csv.py`, are hidden, so the subject imports its own as it would
+  when run on its own.  On exit, every module loaded from `directory` is
+  moved into `cache` and `sys.path` and `sys.modules` are restored, keeping
+  one episode's modules invisible to others.
+
+  Args:
+    directory: Directory holding the subject's modules
+    cache: Modules imported from `directory` during earlier executions
+    excluded: Name of a module never to cache, e.g. the instrumented module
+
+  Yields:
+    None
+  """
+  root = os.path.join(directory, "")
+  saved_path = list(sys.path)
+  local_names = _top_level_modules(directory)
+
+  def is_local(name: str) -> bool:
+    return name.partition(".")[0] in local_names
+
+  shadowed = {
+      name: module
+      for name, module in sys.modules.items()
+      if name in cache or is_local(name)
+  }
+  for name in shadowed:
+    del sys.modules[name]
+  sys.path.insert(0, directory)
+  sys.modules.update(cache)
+  try:
+    yield
+  finally:
+    for name, module in list(sys.modules.items()):
+      filename = getattr(module, "__file__", None)
+      if filename and filename.startswith(root):
+        del sys.modules[name]
+        if name != excluded:
+          cache[name] = module
+      elif is_local(name):
+        del sys.modules[name]
+    sys.modules.update(shadowed)
+    sys.path[:] = saved_path
+
+
+def _top_level_modules(directory: str) -> set[str]:
+  """Return the names of the modules and packages directly in `directory`."""
+  names = set()
+  for entry in os.listdir(directory):
+    name, extension = os.path.splitext(entry)
+    if extension == ".py" and name.isidentifier():
+      names.add(name)
+    elif os.path.isdir(os.path.join(directory, entry)) and entry.isidentifier():
+      names.add(entry)
+  return names
+
+
+def module_name(filename: str, root: str) -> str:
+  """Return the dotted name of the module at `filename` beneath `root`."""
+  relative_path = os.path.relpath(os.path.splitext(filename)[0], root)
+  return relative_path.replace(os.sep, ".")
+
+
+def subject_globals(filename: str, root: str | None = None) -> Dict[str, Any]:
+  """Return the globals in which to execute the subject at `filename`.
+
+  As under `python -m`, the subject executes as `__main__`.  When `root`, the
+  directory on `sys.path` from which a package subject's modules import, is
+  given, the subject's `__package__` and `__spec__` name the package that
+  holds it, so its relative imports resolve.
+
+  Args:
+    filename: Path of the subject
+    root: Directory from which the subject's package imports, if any
+
+  Returns:
+    The subject's initial globals.
+  """
+  exec_globals = {"__name__": "__main__", "__file__": filename}
+  if root is None:
+    exec_globals["__package__"] = None
+    exec_globals["__spec__"] = None
+  else:
+    name = module_name(filename, root)
+    exec_globals["__package__"] = name.rpartition(".")[0]
+    exec_globals["__spec__"] = importlib.machinery.ModuleSpec(
+        name, None, origin=filename
+    )
+  return exec_globals
+
+
+@contextlib.contextmanager
+def line_coverage(filename: str, hits: Counter[int]) -> Iterator[None]:
+  """Count the lines executed in code compiled from `filename`.
+
+  Args:
+    filename: Filename with which the subject's source was compiled
+    hits: Counter to which to add the hit count of each executed line
+
+  Yields:
+    None
+  """
+
+  def trace_lines(frame, event, arg):
+    del arg  # Unused.
+    if event == "line":
+      hits[frame.f_lineno] += 1
+    return trace_lines
+
+  def trace_calls(frame, event, arg):
+    del event, arg  # Unused.
+    if frame.f_code.co_filename != filename:
+      return None
+    return trace_lines
+
+  saved_trace = sys.gettrace()
+  sys.settrace(trace_calls)
+  try:
+    yield
+  finally:
+    sys.settrace(saved_trace)
+
+
+def write_line_hits(filename: str, hits: Counter[int]) -> None:
+  """Write the hit count of each line, as `line_coverage` counts them."""
+  with open(filename, "w", encoding="utf-8") as f:
+    f.writelines(f"{line} {count}\n" for line, count in hits.items())
+
+
+def read_line_hits(filename: str) -> Counter[int]:
+  """Read the hit counts of lines that `write_line_hits` wrote."""
+  hits = collections.Counter()
+  with open(filename, encoding="utf-8") as f:
+    for entry in f:
+      line, count = entry.split()
+      hits[int(line)] += int(count)
+  return hits
+
+
+def _relocate(code: types.CodeType, delta: int) -> types.CodeType:
+  """Return `code`, and the code it nests, moved `delta` lines down."""
+  if not delta:
+    return code
+  consts = tuple(
+      _relocate(const, delta) if isinstance(const, types.CodeType) else const
+      for const in code.co_consts
+  )
+  return code.replace(
+      co_firstlineno=code.co_firstlineno + delta, co_consts=consts
+  )
+
+
+def _first_offset(statement: ast.stmt) -> int:
+  """Return the offset of the first line of `statement` or its decorators."""
+  decorators = getattr(statement, "decorator_list", [])
+  return min(node.lineno for node in [statement, *decorators]) - 1
+
+
+def _is_string_statement(statement: ast.stmt) -> bool:
+  """Return whether `statement` is a string, which may become a docstring."""
+  return (
+      isinstance(statement, ast.Expr)
+      and isinstance(statement.value, ast.Constant)
+      and isinstance(statement.value.value, str)
+  )
+
+
+class IncrementalCompiler:
+  """Compile instrumented versions of a source, reusing unchanged chunks.
+
+  The source's top-level statements are split into chunks:  each function or
+  class definition is a chunk of its own and each run of other statements is
+  another.  Executing the chunks' code in order, in one namespace, executes
+  the module.  A chunk is only recompiled when its instrumented text changes,
+  e.g. when a probe is added to its function, so a step that adds a probe to
+  one function compiles that function alone; the code of the other chunks is
+  only moved to the lines their probes now occupy.
+
+  Sources that import from `__future__` are compiled as a single chunk, as
+  those imports change how the rest of the module compiles.  A string
+  statement following a definition stays in the definition's chunk, as it
+  would otherwise become the module's docstring.
+
+  Attributes:
+    filename: the filename with which chunks are compiled
+    compiled_chunks: the number of chunks the last `compile` compiled
+  """
+
+  def __init__(self, source, filename: str = SUBJECT_FILENAME):
+    """Construct a compiler for instrumented versions of `source`.
+
+    Args:
+      source: the base `source_utils.SourceText` the probes instrument
+      filename: the filename with which to compile chunks
+    """
+    self.filename = filename
+    self.compiled_chunks = 0
+    self._source = source
+    self._cache = {}
+    body = ast.parse(source.text()).body
+    boundaries = {0}
+    if not any(
+        isinstance(node, ast.ImportFrom) and node.module == "__future__"
+        for node in body
+    ):
+      for node, following in zip(body, body[1:] + [None]):
+        if isinstance(
+            node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+        ):
+          boundaries.add(_first_offset(node))
+          # A chunk that started with a string would make it the module's
+          # docstring, so the string stays in the definition's chunk.
+          if following is not None and not _is_string_statement(following):
+            boundaries.add(_first_offset(following))
+    self._starts = sorted(boundaries)
+
+  def _chunk(self, offset: int) -> int:
+    """Return the chunk holding the line of the base source at `offset`."""
+    return bisect.bisect_right(self._starts, offset) - 1
+
+  def compile(self, overlay) -> List[types.CodeType]:
+    """Compile the source with the probes of `overlay` inserted.
+
+    Args:
+      overlay: the `source_utils.ProbeOverlay` to insert
+
+    Returns:
+      The code of each chunk, which executes the module when executed in
+      order in a single namespace.
+    """
+    source = self._source
+    chunks = [[] for _ in self._starts]
+    ends = self._starts[1:] + [len(source)]
+    positions = list(self._starts)
+    for offset, probe in overlay:
+      chunk = self._chunk(offset)
+      chunks[chunk].append(source.segment(positions[chunk], offset))
+      chunks[chunk].append(probe)
+      positions[chunk] = offset
+    codes = []
+    cache = {}
+    self.compiled_chunks = 0
+    first_line = 1
+    for chunk, position, end in zip(chunks, positions, ends):
+      chunk.append(source.segment(position, end))
+      text = "".join(chunk)
+      code = self._cache.get(text) or cache.get(text)
+      if code is None:
+        code = compile(text, self.filename, mode="exec")
+        self.compiled_chunks += 1
+      cache[text] = code
+      codes.append(_relocate(code, first_line - 1))
+      first_line += text.count("\n")
+    self._cache = cache
+    return codes
+
+
+@functools.lru_cache
+def observation_pattern(ise: str) -> re.Pattern[str]:
+  """Return the pattern of the lines probes print when evaluating `ise`.
+
+  Args:
+    ise: the illegal state expression the probes evaluate
+
+  Returns:
+    A pattern whose first group matches the reporting probe's offset and
+    whose second matches the value it observed, as printed.
+  """
+  return re.compile(
+      rf"^{PROBE_PREFIX}@(\d+): '{re.escape(ise)}' = (.*?); bindings: ",
+      re.MULTILINE,
+  )
+
+
+def probe_statement(
+    offset: int, ise: str, identifiers: Iterable[str], indent: str = ""
+) -> str:
+  """Return the statement of a probe that reports `ise` before line `offset`.
+
+  The probe prints a line `observation_pattern(ise)` matches, followed by the
+  bindings of `identifiers`.  It is guarded, as `ise` may be unbound where the
+  probe executes, in which case it reports the value "undefined".
+
+  Args:
+    offset: the offset of the line before which the probe is inserted
+    ise: the illegal state expression the probe evaluates
+    identifiers: the identifiers whose bindings the probe reports
+    indent: the indentation of the line before which the probe is inserted
+
+  Returns:
+    The probe's statement, each of whose lines ends with a newline.
+  """
+  head = f"{PROBE_PREFIX}@{offset}: '{ise}' = "
+  arguments = [repr(head), f"eval({ise!r})", repr("; bindings: ")]
+  bindings = sorted(identifiers)
+  for i, identifier in enumerate(bindings):
+    separator = ", " if i else ""
+    arguments += [repr(f"{separator}{identifier} = "), identifier]
+  if not bindings:
+    arguments.append(repr("None"))
+  undefined = head + "undefined; bindings: None"
+  return (
+      f"{indent}try:\n"
+      f"{indent}  print({', '.join(arguments)}, sep='')\n"
+      f"{indent}except Exception:\n"
+      f"{indent}  print({undefined!r})\n"
+  )
+
+
+class EarlyTermination(BaseException):
+  """Stops a subject once its probes have observed all they can.
+
+  It derives from `BaseException`, so that subjects' `except Exception`
+  handlers let it through.
+  """
+
+
+class ProbeWatcher(io.StringIO):
+  """Capture a subject's output, stopping the subject once probes suffice.
+
+  The watcher raises `EarlyTermination` from the write of a probe's line once
+  every probe has fired, or once the probe closest to, and not after, the bug
+  trap has observed the illegal state expression to be true.  It then ignores
+  further writes, e.g. from the subject's `finally` clauses, so its contents
+  are a prefix of the output of a complete execution.
+
+  Attributes:
+    terminated: whether the watcher stopped the subject
+  """
+
+  def __init__(self, ise: str, probe_offsets: Iterable[int], bug_trap: int):
+    super().__init__()
+    self._pattern = observation_pattern(ise)
+    self._pending = set(probe_offsets)
+    preceding = [offset for offset in self._pending if offset <= bug_trap]
+    self._trap_probe = max(preceding, default=None)
+    self._partial_line = ""
+    self.terminated = False
+
+  def write(self, s: str) -> int:
+    if self.terminated:
+      return len(s)
+    written = super().write(s)
+    if "\n" not in s:
+      self._partial_line += s
+      return written
+    lines = (self._partial_line + s).split("\n")
+    self._partial_line = lines.pop()
+    for line in lines:
+      match = self._pattern.match(line)
+      if match is None:
+        continue
+      offset = int(match.group(1))
+      self._pending.discard(offset)
+      if not self._pending or (
+          offset == self._trap_probe and match.group(2) == "True"
+      ):
+        self.terminated = True
+        raise EarlyTermination
+    return written
+
+
+def main(argv: Sequence[str]) -> None:
+  """Execute an instrumented subject in this process.
+
+  This is the entry point of the worker processes that execute subjects on
+  behalf of `core.AsyncEnvironment`.
+
+  Args:
+    argv: Command line arguments
+  """
+  parser = argparse.ArgumentParser(description="Execute a subject program.")
+  parser.add_argument("subject", help="the instrumented subject to execute")
+  parser.add_argument(
+      "--directory",
+      help="the directory from which a package subject's modules import",
+  )
+  parser.add_argument(
+      "--replay_seed",
+      type=int,
+      help="the seed to which to pin nondeterminism, if replaying",
+  )
+  parser.add_argument(
+      "--early_termination_ise",
+      help=(
+          "the illegal state expression the probes evaluate, if the subject "
+          "should stop once they have fired"
+      ),
+  )
+  parser.add_argument(
+      "--probe_offsets",
+      type=lambda offsets: [int(o) for o in offsets.split(",") if o],
+      default=[],
+      help="comma-separated offsets of the subject's probes",
+  )
+  parser.add_argument(
+      "--bug_trap", type=int, help="the offset of the bug trap"
+  )
+  parser.add_argument(
+      "--coverage_file",
+      help="the file to which to write the subject's line coverage, if any",
+  )
+  args = parser.parse_args(argv[1:])
+
+  with open(args.subject, encoding="utf-8") as f:
+    compiled_source = compile(f.read(), SUBJECT_FILENAME, mode="exec")
+  if args.directory is not None:
+    sys.path.insert(0, args.directory)
+  exec_globals = subject_globals(args.subject, args.directory)
+  if args.replay_seed is not None:
+    pinning = pinned_nondeterminism(args.replay_seed)
+  else:
+    pinning = contextlib.nullcontext()
+  with contextlib.ExitStack() as stack:
+    if args.coverage_file is not None:
+      line_hits = collections.Counter()
+      stack.callback(write_line_hits, args.coverage_file, line_hits)
+      stack.enter_context(line_coverage(SUBJECT_FILENAME, line_hits))
+    if args.early_termination_ise is None:
+      with pinning:
+        exec(compiled_source, exec_globals)  # pylint:disable=exec-used
+      return
+    buffer = ProbeWatcher(
+        args.early_termination_ise, args.probe_offsets, args.bug_trap
+    )
+    try:
+      with (
+          pinning,
+          contextlib.redirect_stdout(buffer),
+          contextlib.redirect_stderr(buffer),
+      ):
+        exec(compiled_source, exec_globals)  # pylint:disable=exec-used
+    except EarlyTermination:
+      pass
+    finally:
+      sys.stdout.write(buffer.getvalue())
+    if buffer.terminated:
+      sys.exit(EARLY_TERMINATION_STATUS)
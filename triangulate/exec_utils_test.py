@@ -0,0 +1,203 @@
+# Copyright 2023 The triangulate Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for exec_utils."""
+
+import contextlib
+import datetime
+import io
+import os
+import random
+import secrets
+import time
+
+from absl.testing import absltest
+from triangulate import exec_utils
+from triangulate import source_utils
+
+
+def _draw():
+  return random.random(), time.time(), os.urandom(8)
+
+
+class PinnedNondeterminismTest(absltest.TestCase):
+
+  def test_same_seed_replays_same_values(self):
+    with exec_utils.pinned_nondeterminism(7):
+      first = _draw()
+    with exec_utils.pinned_nondeterminism(7):
+      second = _draw()
+    self.assertEqual(first, second)
+    self.assertEqual(first[1], exec_utils.FROZEN_TIME)
+
+  def test_restores_sources_on_exit(self):
+    random.seed(3)
+    expected = random.random()
+    random.seed(3)
+    with exec_utils.pinned_nondeterminism(7):
+      _draw()
+    self.assertEqual(random.random(), expected)
+    self.assertNotEqual(time.time(), exec_utils.FROZEN_TIME)
+
+  def test_pins_unseeded_generators_clocks_and_dates(self):
+    def draw():
+      return (
+          random.Random().random(),
+          random.SystemRandom().random(),
+          secrets.token_hex(8),
+          datetime.datetime.now(),
+          datetime.date.today(),
+          [time.monotonic(), time.perf_counter()],
+      )
+
+    with exec_utils.pinned_nondeterminism(7):
+      first = draw()
+    with exec_utils.pinned_nondeterminism(7):
+      second = draw()
+    self.assertEqual(first, second)
+    self.assertEqual(
+        first[3], datetime.datetime.fromtimestamp(exec_utils.FROZEN_TIME)
+    )
+    self.assertEqual(first[5], [exec_utils.CLOCK_TICK] * 2)
+
+  def test_restores_clocks_and_dates_on_exit(self):
+    with exec_utils.pinned_nondeterminism(7):
+      pass
+    self.assertIs(datetime.datetime, type(datetime.datetime.now()))
+    self.assertNotEqual(random.Random().random(), random.Random().random())
+    self.assertGreater(time.monotonic(), 1)
+
+
+def _probe_line(offset, value):
+  return f"{exec_utils.PROBE_PREFIX}@{offset}: 'x > 1' = {value}; bindings: x"
+
+
+class ProbeWatcherTest(absltest.TestCase):
+
+  def test_terminates_once_all_probes_fire(self):
+    watcher = exec_utils.ProbeWatcher("x > 1", [3, 8], bug_trap=20)
+    print("subject output", file=watcher)
+    print(_probe_line(3, False), file=watcher)
+    self.assertFalse(watcher.terminated)
+    with self.assertRaises(exec_utils.EarlyTermination):
+      print(_probe_line(8, False), file=watcher)
+    print("tail", file=watcher)
+    self.assertTrue(watcher.terminated)
+    self.assertNotIn("tail", watcher.getvalue())
+
+  def test_terminates_when_probe_closest_to_trap_observes_illegal_state(self):
+    watcher = exec_utils.ProbeWatcher("x > 1", [3, 8, 30], bug_trap=20)
+    print(_probe_line(3, True), file=watcher)
+    self.assertFalse(watcher.terminated)
+    with self.assertRaises(exec_utils.EarlyTermination):
+      print(_probe_line(8, True), file=watcher)
+
+
+class ProbeStatementTest(absltest.TestCase):
+
+  def test_probe_reports_observations_the_pattern_matches(self):
+    ise = "x in {'a', \"b\"}"
+    probe = exec_utils.probe_statement(4, ise, ["y", "x"], indent="  ")
+    self.assertTrue(probe.startswith("  try:\n"))
+    statement = "def f(x, y):\n" + probe + "f('a', 2)\nf('c', 3)\n"
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+      exec(statement, {})  # pylint:disable=exec-used
+    head = f"{exec_utils.PROBE_PREFIX}@4: '{ise}' = "
+    self.assertEqual(
+        output.getvalue().splitlines(),
+        [
+            head + "True; bindings: x = a, y = 2",
+            head + "False; bindings: x = c, y = 3",
+        ],
+    )
+    matches = exec_utils.observation_pattern(ise).findall(output.getvalue())
+    self.assertEqual(matches, [("4", "True"), ("4", "False")])
+
+  def test_unbound_expression_is_undefined(self):
+    output = io.StringIO()
+    probe = exec_utils.probe_statement(0, "z > 1", ["z"])
+    with contextlib.redirect_stdout(output):
+      exec(probe, {})  # pylint:disable=exec-used
+    self.assertEqual(
+        exec_utils.observation_pattern("z > 1").findall(output.getvalue()),
+        [("0", "undefined")],
+    )
+
+
+_CHUNKED_SOURCE = """\
+import functools
+total = 0
+
+
+@functools.cache
+def f(x):
+  return x + 1
+
+
+class C:
+  y = f(1)
+total = f(C.y)
+def g(x):
+  return 1 / x
+g(total - 3)
+"""
+
+
+class IncrementalCompilerTest(absltest.TestCase):
+
+  def _execute(self, codes):
+    namespace = {}
+    try:
+      for code in codes:
+        exec(code, namespace)  # pylint:disable=exec-used
+    except ZeroDivisionError as e:
+      return namespace["total"], e.__traceback__.tb_next.tb_next.tb_lineno
+    self.fail("g did not raise")
+
+  def test_recompiles_only_changed_chunks(self):
+    source = source_utils.intern_source(_CHUNKED_SOURCE)
+    compiler = exec_utils.IncrementalCompiler(source)
+    overlay = source_utils.ProbeOverlay()
+    self.assertEqual(self._execute(compiler.compile(overlay)), (3, 14))
+    self.assertEqual(compiler.compiled_chunks, 6)
+
+    overlay.add(13, "  x = x + 0\n  pass\n")
+    self.assertEqual(self._execute(compiler.compile(overlay)), (3, 16))
+    self.assertEqual(compiler.compiled_chunks, 1)
+
+    overlay.add(4, "@functools.cache\n")
+    codes = compiler.compile(overlay)
+    self.assertEqual(compiler.compiled_chunks, 1)
+    self.assertEqual(self._execute(codes), (3, 17))
+    instrumented = "".join(overlay.materialise(source)).splitlines()
+    self.assertEqual(instrumented[17 - 1], "  return 1 / x")
+
+  def test_strings_after_definitions_are_not_docstrings(self):
+    source = source_utils.intern_source(
+        '"""Module doc."""\n'
+        "def f():\n"
+        "  pass\n"
+        '"""Not a docstring."""\n'
+        "doc = __doc__\n"
+    )
+    compiler = exec_utils.IncrementalCompiler(source)
+    namespace = {}
+    for code in compiler.compile(source_utils.ProbeOverlay()):
+      exec(code, namespace)  # pylint:disable=exec-used
+    self.assertEqual(namespace["doc"], "Module doc.")
+
+
+if __name__ == "__main__":
+  absltest.main()
@@ -0,0 +1,452 @@
+# Copyright 2023 The triangulate Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark how efficiently each localisation strategy finds known faults.
+
+The corpus consists of buggy programs generated from seeds.  Each program
+accumulates `readings` in straight-line code, one of whose updates is faulty
+and pushes `readings` past a limit, which a guarded assertion traps.  A
+strategy has localised the fault once, in the order the probes fired, the last
+probe to observe the illegal state expression to be false and the first to
+observe it to be true bracket the faulty update and no other update.
+
+For each strategy, the benchmark reports the executions it takes to localise
+the fault, the wall time and the peak traced memory of each episode, with
+bootstrap confidence intervals across seeds.  Memory is traced in a separate
+pass over the episodes, as tracing slows them.  Given a baseline report, it
+fails when a strategy has regressed.  `testdata/localisation_baseline.json`
+is the baseline of a small corpus, which `localisation_benchmark_test`
+gates against; regenerate it with
+
+  python -m triangulate.localisation_benchmark --num_subjects=5 \
+      --num_updates=10 --max_steps=20 \
+      --output=triangulate/testdata/localisation_baseline.json
+"""
+
+import dataclasses
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Dict, List, Sequence, Tuple
+
+from absl import app
+from absl import flags
+from absl import logging
+import numpy as np
+from triangulate import core
+from triangulate import policy_utils
+from triangulate import sampling_utils
+
+flags.DEFINE_integer("num_subjects", 20, help="Number of generated subjects.")
+flags.DEFINE_integer(
+    "num_updates", 30, help="Number of updates of `readings` per subject."
+)
+flags.DEFINE_integer(
+    "max_steps", 50, help="Executions after which an episode gives up."
+)
+flags.DEFINE_list(
+    "strategies", ["random", "linear_bandit"], help="Strategies to benchmark."
+)
+flags.DEFINE_string("output", None, help="File to which to write the report.")
+flags.DEFINE_string(
+    "baseline", None, help="Report against which to gate regressions."
+)
+flags.DEFINE_float(
+    "tolerance",
+    0.1,
+    help=(
+        "Relative increase in executions to localise, or absolute drop in "
+        "the fraction of faults localised, that counts as a regression."
+    ),
+)
+flags.DEFINE_float(
+    "resource_tolerance",
+    0.5,
+    help=(
+        "Relative increase in wall time or peak memory that counts as a "
+        "regression."
+    ),
+)
+
+# The strategies' policies; None places probes at random.
+STRATEGIES = {
+    "random": lambda: None,
+    "linear_bandit": policy_utils.LinearBanditPolicy,
+}
+_LIMIT_MARGIN = 10
+
+
+@dataclasses.dataclass(frozen=True)
+class BenchmarkSubject:
+  """A generated buggy program and its known fault.
+
+  Attributes:
+    seed: the seed from which the subject was generated
+    source: the program
+    illegal_state_expr: the complement of the bug trap's assertion
+    bug_trap: offset of the assertion that traps the bug
+    fault: offset of the faulty statement
+    suspects: offsets of every statement that may change the illegal state
+      expression's value, including the fault
+  """
+
+  seed: int
+  source: str
+  illegal_state_expr: str
+  bug_trap: int
+  fault: int
+  suspects: Tuple[int, ...]
+
+
+def generate_subject(seed: int, num_updates: int = 30) -> BenchmarkSubject:
+  """Generate a buggy program whose fault is known.
+
+  Args:
+    seed: the seed from which to generate the program
+    num_updates: the number of updates of `readings`, including the fault
+
+  Returns:
+    The generated subject.
+  """
+  rng = np.random.default_rng(seed)
+  amounts = rng.integers(1, 10, size=num_updates)
+  limit = int(amounts.sum()) + _LIMIT_MARGIN
+  fault_index = int(rng.integers(1, num_updates))
+  amounts[fault_index] = limit + 1
+
+  lines = [
+      f'"""This file is a benchmark subject generated from seed {seed}."""\n',
+      "\n",
+      "\n",
+      "def scale(reading, factor):\n",
+      "  return reading * factor\n",
+      "\n",
+      "\n",
+      "# Accumulate the readings; one of the updates is faulty.\n",
+      "readings = 0\n",
+      "checksum = 0\n",
+  ]
+  suspects = [len(lines) - 2]
+  fault = None
+  for i, amount in enumerate(amounts):
+    if i == fault_index:
+      fault = len(lines)
+    suspects.append(len(lines))
+    if rng.random() < 0.5:
+      lines.append(f"readings += {amount}\n")
+    else:
+      lines.append(f"readings = sum((readings, {amount}))\n")
+    # Statements that leave `readings` alone, which probes need not query.
+    for _ in range(rng.integers(0, 3)):
+      lines.append(f"checksum = (checksum * 31 + {amount}) % 997\n")
+  lines += [
+      "\n",
+      "try:\n",
+      f'  assert readings <= {limit}, f"The readings {{readings}} exceed'
+      f' {limit}."\n',
+      "except AssertionError as error:\n",
+      "  print(error)\n",
+      'print(f"Checksum: {checksum}")\n',
+  ]
+  return BenchmarkSubject(
+      seed=seed,
+      source="".join(lines),
+      illegal_state_expr=f"readings > {limit}",
+      bug_trap=len(lines) - 4,
+      fault=fault,
+      suspects=tuple(suspects),
+  )
+
+
+def localised(
+    observations: Sequence[Tuple[int, str]], subject: BenchmarkSubject
+) -> bool:
+  """Return whether `observations` pin the subject's fault.
+
+  Args:
+    observations: the offset and observed value of each probe, in the order
+      the probes fired
+    subject: the subject on which the observations were made
+
+  Returns:
+    Whether the fault is the only suspect between the last probe to observe
+    the illegal state expression to be false, or undefined, and the first to
+    observe it to be true.
+  """
+  start, end = -1, sys.maxsize
+  for offset, value in observations:
+    if value == "True":
+      end = offset
+      break
+    start = offset
+  bracketed = [s for s in subject.suspects if start <= s < end]
+  return bracketed == [subject.fault]
+
+
+def run_episode(
+    subject: BenchmarkSubject,
+    path: str,
+    strategy: str,
+    max_steps: int,
+) -> Dict[str, Any]:
+  """Localise the fault of a subject with a strategy.
+
+  Args:
+    subject: the subject to localise
+    path: the file holding the subject's source
+    strategy: the name of the strategy, a key of `STRATEGIES`
+    max_steps: the executions after which to give up
+
+  Returns:
+    The executions the strategy took to localise the fault, or `max_steps +
+    1` if it did not, whether it localised it, and the episode's wall time.
+  """
+  sampling_utils.reseed(subject.seed)
+  start = time.perf_counter()
+  env = core.Environment(
+      buggy_program_name=path,
+      illegal_state_expr=subject.illegal_state_expr,
+      bug_triggering_input="",
+      bug_trap=subject.bug_trap,
+      burnin=0,
+      max_steps=max_steps,
+      probe_output_filename="",
+      deterministic_replay=True,
+  )
+  try:
+    localiser = core.Localiser(env, policy=STRATEGIES[strategy]())
+    executions = max_steps + 1
+    while not env.terminate():
+      env.update(localiser.pick_action(env.state, env.reward()))
+      if localised(env.observations, subject):
+        executions = env.steps
+        break
+  finally:
+    env.cleanup()
+  return {
+      "executions": executions,
+      "localised": executions <= max_steps,
+      "seconds": time.perf_counter() - start,
+  }
+
+
+def peak_episode_bytes(
+    subject: BenchmarkSubject,
+    path: str,
+    strategy: str,
+    max_steps: int,
+) -> int:
+  """Return the peak memory traced while `run_episode` localises a subject.
+
+  Tracing slows the episode, so its wall time is measured in a separate run.
+
+  Args:
+    subject: the subject to localise
+    path: the file holding the subject's source
+    strategy: the name of the strategy, a key of `STRATEGIES`
+    max_steps: the executions after which to give up
+
+  Returns:
+    The peak traced memory, in bytes.
+  """
+  tracemalloc.start()
+  try:
+    run_episode(subject, path, strategy, max_steps)
+    return tracemalloc.get_traced_memory()[1]
+  finally:
+    tracemalloc.stop()
+
+
+def confidence_interval(
+    samples: Sequence[float], confidence: float = 0.95, resamples: int = 2000
+) -> Tuple[float, float]:
+  """Return a bootstrap confidence interval of the mean of `samples`."""
+  rng = np.random.default_rng(0)
+  samples = np.asarray(samples, dtype=np.float64)
+  indices = rng.integers(0, len(samples), size=(resamples, len(samples)))
+  means = samples[indices].mean(axis=1)
+  tail = 100 * (1 - confidence) / 2
+  low, high = np.percentile(means, [tail, 100 - tail])
+  return float(low), float(high)
+
+
+def _summarise(samples: Sequence[float]) -> Dict[str, Any]:
+  return {
+      "mean": float(np.mean(samples)),
+      "ci": confidence_interval(samples),
+  }
+
+
+def run_benchmark(
+    seeds: Sequence[int],
+    strategies: Sequence[str],
+    num_updates: int = 30,
+    max_steps: int = 50,
+) -> Dict[str, Any]:
+  """Benchmark strategies on the subjects generated from `seeds`.
+
+  Args:
+    seeds: the seeds of the corpus's subjects
+    strategies: the names of the strategies to benchmark
+    num_updates: the number of updates in each subject
+    max_steps: the executions after which an episode gives up
+
+  Returns:
+    The report:  the benchmark's configuration and, for each strategy, the
+    mean and confidence interval of its executions to localise, wall time
+    and peak memory, along with the fraction of faults it localised.
+  """
+  report = {
+      "config": {
+          "seeds": list(seeds),
+          "num_updates": num_updates,
+          "max_steps": max_steps,
+      },
+      "strategies": {},
+  }
+  subjects = [generate_subject(seed, num_updates) for seed in seeds]
+  with tempfile.TemporaryDirectory() as directory:
+    paths = []
+    for subject in subjects:
+      paths.append(os.path.join(directory, f"subject_{subject.seed}.py"))
+      with open(paths[-1], "w", encoding="utf-8") as f:
+        f.write(subject.source)
+    for strategy in strategies:
+      episodes = [
+          run_episode(subject, path, strategy, max_steps)
+          for subject, path in zip(subjects, paths)
+      ]
+      for episode, subject, path in zip(episodes, subjects, paths):
+        episode["peak_bytes"] = peak_episode_bytes(
+            subject, path, strategy, max_steps
+        )
+      report["strategies"][strategy] = {
+          "localised": float(np.mean([e["localised"] for e in episodes])),
+          **{
+              metric: _summarise([e[metric] for e in episodes])
+              for metric in ("executions", "seconds", "peak_bytes")
+          },
+      }
+  return report
+
+
+def find_regressions(
+    report: Dict[str, Any],
+    baseline: Dict[str, Any],
+    tolerance: float = 0.1,
+    resource_tolerance: float = 0.5,
+) -> List[str]:
+  """Compare a report with a baseline report.
+
+  A metric regresses when even the lower bound of its confidence interval
+  exceeds the baseline's mean by more than the tolerance, so noise alone
+  rarely fails the gate.
+
+  Args:
+    report: the report to check
+    baseline: the report against which to check it
+    tolerance: the relative increase in executions to localise, or absolute
+      drop in the fraction of faults localised, that counts as a regression
+    resource_tolerance: the relative increase in wall time or peak memory
+      that counts as a regression
+
+  Returns:
+    A description of each regression.
+
+  Raises:
+    ValueError if the reports' configurations differ.
+  """
+  if report["config"] != baseline["config"]:
+    raise ValueError(
+        "Error: the report and baseline benchmark different corpora."
+    )
+  regressions = []
+  for strategy, metrics in report["strategies"].items():
+    expected = baseline["strategies"].get(strategy)
+    if expected is None:
+      continue
+    if metrics["localised"] < expected["localised"] - tolerance:
+      regressions.append(
+          f"{strategy}: localised {metrics['localised']:.0%} of faults,"
+          f" down from {expected['localised']:.0%}."
+      )
+    for metric, metric_tolerance in (
+        ("executions", tolerance),
+        ("seconds", resource_tolerance),
+        ("peak_bytes", resource_tolerance),
+    ):
+      bound = expected[metric]["mean"] * (1 + metric_tolerance)
+      if metrics[metric]["ci"][0] > bound:
+        regressions.append(
+            f"{strategy}: mean {metric} rose from"
+            f" {expected[metric]['mean']:.4g} to {metrics[metric]['mean']:.4g}."
+        )
+  return regressions
+
+
+def main(argv: Sequence[str]) -> None:
+  """Program entry point."""
+
+  if len(argv) > 1:
+    raise app.UsageError("Too many command-line arguments.")
+
+  for strategy in flags.FLAGS.strategies:
+    if strategy not in STRATEGIES:
+      raise app.UsageError(f"Unknown strategy {strategy}.")
+
+  report = run_benchmark(
+      range(flags.FLAGS.num_subjects),
+      flags.FLAGS.strategies,
+      num_updates=flags.FLAGS.num_updates,
+      max_steps=flags.FLAGS.max_steps,
+  )
+  print(
+      f"{'strategy':<16} {'localised':>9} {'executions (95% CI)':>24}"
+      f" {'ms (95% CI)':>22} {'peak KiB':>9}"
+  )
+  for strategy, metrics in report["strategies"].items():
+    executions, seconds = metrics["executions"], metrics["seconds"]
+    print(
+        f"{strategy:<16} {metrics['localised']:>9.0%}"
+        f" {executions['mean']:>7.1f} ({executions['ci'][0]:5.1f},"
+        f" {executions['ci'][1]:5.1f})"
+        f" {1000 * seconds['mean']:>7.1f} ({1000 * seconds['ci'][0]:5.1f},"
+        f" {1000 * seconds['ci'][1]:5.1f})"
+        f" {metrics['peak_bytes']['mean'] / 1024:>9.0f}"
+    )
+  if flags.FLAGS.output:
+    with open(flags.FLAGS.output, "w", encoding="utf-8") as f:
+      json.dump(report, f, indent=2)
+      f.write("\n")
+
+  if flags.FLAGS.baseline:
+    with open(flags.FLAGS.baseline, encoding="utf-8") as f:
+      baseline = json.load(f)
+    regressions = find_regressions(
+        report,
+        baseline,
+        tolerance=flags.FLAGS.tolerance,
+        resource_tolerance=flags.FLAGS.resource_tolerance,
+    )
+    for regression in regressions:
+      logging.error("Regression: %s", regression)
+    if regressions:
+      sys.exit(1)
+
+
+if __name__ == "__main__":
+  app.run(main)
@@ -0,0 +1,107 @@
+# Copyright 2023 The triangulate Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for localisation_benchmark."""
+
+import contextlib
+import copy
+import io
+import json
+import os
+
+from absl.testing import absltest
+from triangulate import localisation_benchmark
+
+BASELINE_PATH = os.path.join(
+    absltest.get_default_test_srcdir(),
+    "triangulate/testdata/localisation_baseline.json",
+)
+
+
+def _evaluate_after(subject, num_lines):
+  namespace = {}
+  lines = subject.source.splitlines(keepends=True)
+  exec("".join(lines[:num_lines]), namespace)  # pylint:disable=exec-used
+  return eval(subject.illegal_state_expr, namespace)  # pylint:disable=eval-used
+
+
+class LocalisationBenchmarkTest(absltest.TestCase):
+
+  def test_generated_fault_raises_illegal_state(self):
+    subject = localisation_benchmark.generate_subject(seed=3, num_updates=10)
+    self.assertEqual(
+        subject, localisation_benchmark.generate_subject(3, num_updates=10)
+    )
+    self.assertIn(subject.fault, subject.suspects)
+    self.assertFalse(_evaluate_after(subject, subject.fault))
+    self.assertTrue(_evaluate_after(subject, subject.fault + 1))
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+      exec(subject.source, {})  # pylint:disable=exec-used
+    self.assertStartsWith(output.getvalue(), "The readings")
+
+  def test_localised_requires_a_tight_bracket(self):
+    subject = localisation_benchmark.BenchmarkSubject(
+        seed=0,
+        source="",
+        illegal_state_expr="x",
+        bug_trap=20,
+        fault=12,
+        suspects=(8, 10, 12, 14),
+    )
+    localised = localisation_benchmark.localised
+    self.assertTrue(
+        localised([(5, "False"), (12, "False"), (13, "True")], subject)
+    )
+    self.assertFalse(localised([(11, "False"), (15, "True")], subject))
+    self.assertFalse(localised([(11, "undefined"), (12, "False")], subject))
+
+  def test_gate_flags_regressions(self):
+    report = localisation_benchmark.run_benchmark(
+        seeds=range(3), strategies=["random"], num_updates=6, max_steps=20
+    )
+    executions = report["strategies"]["random"]["executions"]
+    self.assertBetween(executions["mean"], *executions["ci"])
+    self.assertEmpty(localisation_benchmark.find_regressions(report, report))
+
+    baseline = copy.deepcopy(report)
+    baseline["strategies"]["random"]["executions"]["mean"] = 0.5
+    (regression,) = localisation_benchmark.find_regressions(report, baseline)
+    self.assertStartsWith(regression, "random: mean executions")
+
+    baseline["config"]["max_steps"] = 10
+    with self.assertRaises(ValueError):
+      localisation_benchmark.find_regressions(report, baseline)
+
+  def test_no_regressions_against_baseline(self):
+    with open(BASELINE_PATH, encoding="utf-8") as f:
+      baseline = json.load(f)
+    config = baseline["config"]
+    report = localisation_benchmark.run_benchmark(
+        seeds=config["seeds"],
+        strategies=list(baseline["strategies"]),
+        num_updates=config["num_updates"],
+        max_steps=config["max_steps"],
+    )
+    # Wall time and memory vary across machines, unlike the seeded episodes,
+    # so only gross resource regressions fail the gate.
+    self.assertEmpty(
+        localisation_benchmark.find_regressions(
+            report, baseline, resource_tolerance=4.0
+        )
+    )
+
+
+if __name__ == "__main__":
+  absltest.main()
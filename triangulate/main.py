@@ -14,12 +14,17 @@
 
 """Main script."""
 
-import os
+import contextlib
 
 from absl import app
 from absl import flags
 from absl import logging
+# Unlike the package, this script imports core eagerly: every invocation but
+# `--help` localises, and its flags must be defined before `app.run` parses
+# them.
 from triangulate import core
+from triangulate import policy_utils
+from triangulate import trajectory_utils
 
 Localiser = core.Localiser
 Environment = core.Environment
@@ -31,6 +36,15 @@ flags.DEFINE_string(
     required=True,
     short_name="p",
 )
+flags.DEFINE_string(
+    "entry_module",
+    None,
+    short_name="e",
+    help=(
+        "When the buggy program is a package directory, the path, relative "
+        "to that directory, of the module to instrument and execute."
+    ),
+)
 flags.DEFINE_string(
     "illegal_state_expr",
     None,
@@ -86,6 +100,38 @@ flags.DEFINE_string(
     short_name="o",
     help="maximum simulation steps",
 )
+flags.DEFINE_enum(
+    "policy",
+    "random",
+    ["random", "linear_bandit"],
+    help="How the localiser chooses where to insert probes.",
+)
+flags.DEFINE_string(
+    "trajectory_dir",
+    None,
+    help="Directory to which to append a columnar record of every step.",
+)
+flags.DEFINE_bool(
+    "deterministic_replay",
+    False,
+    help=(
+        "Pin the buggy program's sources of nondeterminism, e.g. `random` "
+        "and `time`, so that it produces a single output and needs no burnin."
+    ),
+)
+flags.DEFINE_bool(
+    "early_termination",
+    False,
+    help=(
+        "Stop each execution of the buggy program once its probes have "
+        "observed the illegal state."
+    ),
+)
+flags.DEFINE_integer(
+    "replay_seed",
+    0,
+    help="Seed to which deterministic replay pins nondeterminism.",
+)
 
 
 def main(argv):
@@ -106,21 +152,37 @@ def main(argv):
         "Please enter the name of the buggy program: "
     )
 
-  env = Environment(**flags.FLAGS)
-  localiser = Localiser(env)
+  if flags.FLAGS.trajectory_dir:
+    recording = trajectory_utils.TrajectoryRecorder(flags.FLAGS.trajectory_dir)
+  else:
+    recording = contextlib.nullcontext()
+
+  # The recorder flushes its partial shard on exit, even if a step raises.
+  with recording as trajectory_recorder:
+    env = Environment(
+        buggy_program_name=flags.FLAGS.buggy_program_name,
+        illegal_state_expr=flags.FLAGS.illegal_state_expr,
+        bug_triggering_input=flags.FLAGS.bug_triggering_input,
+        bug_trap=flags.FLAGS.bug_trap,
+        burnin=flags.FLAGS.burnin,
+        max_steps=flags.FLAGS.max_steps,
+        probe_output_filename=flags.FLAGS.probe_output_filename,
+        deterministic_replay=flags.FLAGS.deterministic_replay,
+        replay_seed=flags.FLAGS.replay_seed,
+        entry_module=flags.FLAGS.entry_module,
+        trajectory_recorder=trajectory_recorder,
+        early_termination=flags.FLAGS.early_termination,
+    )
+    if flags.FLAGS.policy == "linear_bandit":
+      localiser = Localiser(env, policy=policy_utils.LinearBanditPolicy())
+    else:
+      localiser = Localiser(env)
 
-  while not env.terminate():
-    env.update(localiser.pick_action(env.state, env.reward()))
+    while not env.terminate():
+      env.update(localiser.pick_action(env.state, env.reward()))
 
   if flags.FLAGS.loglevel != logging.DEBUG:
-    try:
-      os.remove(env.instrumented_program_name)
-    except IOError as e:
-      logging.error(
-          "Error: Unable to remove temp file '%s'.",
-          env.instrumented_program_name,
-      )
-      raise e
+    env.cleanup()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,177 @@
+# Copyright 2023 The triangulate Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Probe placement policies."""
+
+from typing import Sequence
+
+import numpy as np
+from triangulate import sampling_utils
+
+# The number of features `insertion_point_features` computes.
+NUM_FEATURES = 5
+
+
+def insertion_point_features(
+    insertion_points: np.ndarray,
+    num_lines: int,
+    bug_trap: int,
+    hits: np.ndarray | None = None,
+) -> np.ndarray:
+  """Compute the features of every insertion point at once.
+
+  Args:
+    insertion_points: 1-based lines before which probes may be inserted
+    num_lines: number of lines in the subject
+    bug_trap: 0-based offset of the assertion that traps the bug
+    hits: optional number of times the baseline executed each point
+
+  Returns:
+    A matrix with a row of `NUM_FEATURES` features per insertion point:
+    a bias, the point's relative position in the subject, its relative
+    distance to the bug trap, whether it precedes the trap and its log hit
+    count.
+  """
+  offsets = insertion_points.astype(np.float64) - 1
+  scale = max(num_lines, 1)
+  features = np.empty((len(insertion_points), NUM_FEATURES))
+  features[:, 0] = 1.0
+  features[:, 1] = offsets / scale
+  features[:, 2] = np.abs(bug_trap - offsets) / scale
+  features[:, 3] = offsets <= bug_trap
+  features[:, 4] = 0.0 if hits is None else np.log1p(hits)
+  return features
+
+
+class Policy:
+  """Baseclass for policies that choose where to insert probes."""
+
+  def select(
+      self, features: np.ndarray, insertion_points: np.ndarray
+  ) -> np.ndarray:
+    """Choose the insertion points at which to probe.
+
+    Args:
+      features: the features of each insertion point, one row per point
+      insertion_points: the candidate insertion points
+
+    Returns:
+      The chosen insertion points.
+    """
+    raise NotImplementedError
+
+  def retain(self, insertion_points: np.ndarray) -> None:
+    """Restrict the last selection to the points that were actually probed.
+
+    Args:
+      insertion_points: the chosen insertion points that received a probe
+    """
+    del insertion_points  # Every chosen point is probed by default.
+
+  def update(self, reward: float | np.ndarray) -> None:
+    """Learn from the reward earned by the last selection.
+
+    Args:
+      reward: the reward for the last selection, or for each of its retained
+        points, in the order they were retained
+    """
+    raise NotImplementedError
+
+
+class LinearBanditPolicy(Policy):
+  """A linear upper-confidence-bound bandit over insertion points.
+
+  Each insertion point is an arm whose expected reward is linear in its
+  features.  Every step scores all points in one vectorised operation,
+  draws the number of probes from a Zipfian and probes the top-scoring
+  points; only the points that were actually probed are then credited with
+  their rewards.
+
+  Attributes:
+    alpha: the width of the confidence bound, which drives exploration
+    precision: the regularised Gram matrix of the probed points' features
+    reward_features: the reward-weighted sum of the probed points' features
+  """
+
+  def __init__(self, alpha: float = 1.0, regularisation: float = 1.0):
+    self.alpha = alpha
+    self.precision = regularisation * np.eye(NUM_FEATURES)
+    self.reward_features = np.zeros(NUM_FEATURES)
+    self._covariance = np.linalg.inv(self.precision)
+    self._selected = None
+    self._selected_points = None
+
+  def scores(self, features: np.ndarray) -> np.ndarray:
+    """Return the upper confidence bound of each insertion point's reward."""
+    weights = self._covariance @ self.reward_features
+    widths = np.einsum("ij,jk,ik->i", features, self._covariance, features)
+    return features @ weights + self.alpha * np.sqrt(widths)
+
+  def select(
+      self, features: np.ndarray, insertion_points: np.ndarray
+  ) -> np.ndarray:
+    num_probes = sampling_utils.sample_zipfian(
+        1, support_size=len(insertion_points)
+    )[0]
+    # Break ties between equally scored points at random.
+    scores = self.scores(features)
+    scores += 1e-9 * sampling_utils.rng.random(len(scores))
+    chosen = np.argpartition(-scores, num_probes - 1)[:num_probes]
+    self._selected = features[chosen]
+    self._selected_points = insertion_points[chosen]
+    return self._selected_points
+
+  def retain(self, insertion_points: np.ndarray) -> None:
+    if self._selected is None:
+      return
+    rows = [
+        np.flatnonzero(self._selected_points == point)[0]
+        for point in insertion_points
+    ]
+    self._selected = self._selected[rows]
+    self._selected_points = self._selected_points[rows]
+
+  def update(self, reward: float | np.ndarray) -> None:
+    if self._selected is None:
+      return
+    rewards = np.broadcast_to(reward, len(self._selected))
+    self.precision += self._selected.T @ self._selected
+    self.reward_features += rewards @ self._selected
+    self._covariance = np.linalg.inv(self.precision)
+    self._selected = None
+    self._selected_points = None
+
+
+def features_for_state(
+    state,
+    insertion_points: Sequence[int],
+    hits: np.ndarray | None = None,
+) -> np.ndarray:
+  """Compute the features of a state's insertion points.
+
+  Args:
+    state: the current `core.State`
+    insertion_points: the state's candidate insertion points
+    hits: optional number of times the baseline executed each candidate,
+      e.g. the state's insertion weights at the candidates
+
+  Returns:
+    The features of each insertion point.
+  """
+  return insertion_point_features(
+      np.asarray(insertion_points),
+      len(state.source),
+      state.bug_trap,
+      hits,
+  )
@@ -0,0 +1,66 @@
+# Copyright 2023 The triangulate Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for policy_utils."""
+
+from absl.testing import absltest
+import numpy as np
+from triangulate import policy_utils
+
+
+class LinearBanditPolicyTest(absltest.TestCase):
+
+  def test_features(self):
+    features = policy_utils.insertion_point_features(
+        np.array([1, 11]), num_lines=20, bug_trap=5
+    )
+    np.testing.assert_allclose(
+        features, [[1.0, 0.0, 0.25, 1.0, 0.0], [1.0, 0.5, 0.25, 0.0, 0.0]]
+    )
+
+  def test_learns_rewarding_insertion_points(self):
+    insertion_points = np.arange(1, 21)
+    bug_trap = 9
+    features = policy_utils.insertion_point_features(
+        insertion_points, num_lines=20, bug_trap=bug_trap
+    )
+    policy = policy_utils.LinearBanditPolicy(alpha=0.1)
+    for _ in range(200):
+      chosen = policy.select(features, insertion_points)
+      # Only probes after the bug trap earn a reward.
+      policy.update(float(np.all(chosen - 1 > bug_trap)))
+    best = insertion_points[np.argmax(policy.scores(features))]
+    self.assertGreater(best - 1, bug_trap)
+
+  def test_credits_only_retained_points(self):
+    insertion_points = np.arange(1, 21)
+    features = policy_utils.insertion_point_features(
+        insertion_points, num_lines=20, bug_trap=9
+    )
+    policy = policy_utils.LinearBanditPolicy()
+    chosen = []
+    while len(chosen) < 2:
+      chosen = policy.select(features, insertion_points)
+    policy.retain(chosen[1:2])
+    policy.update(np.array([1.0]))
+    retained = features[chosen[1] - 1]
+    np.testing.assert_allclose(
+        policy.precision,
+        np.eye(policy_utils.NUM_FEATURES) + np.outer(retained, retained),
+    )
+    np.testing.assert_allclose(policy.reward_features, retained)
+
+
+if __name__ == "__main__":
+  absltest.main()
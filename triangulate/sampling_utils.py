@@ -17,9 +17,16 @@
 from typing import List
 import numpy as np
 
+# The generator every sampler, and every policy, draws from.
 rng = np.random.default_rng(seed=654)
 
 
+def reseed(seed: int) -> None:
+  """Replace the shared generator with one seeded with `seed`."""
+  global rng
+  rng = np.random.default_rng(seed=seed)
+
+
 def sample_zipfian(
     num_samples: int, zipf_param: float = 1.5, support_size: int = 10
 ) -> np.ndarray:
@@ -62,3 +69,26 @@ def sample_wo_replacement_uniform(
         " cannot exceed the cardinality of the set."
     )
   return rng.choice(support, size=num_samples, replace=False)
+
+
+def sample_wo_replacement_weighted(
+    num_samples: int, support: List[int], weights: np.ndarray
+) -> np.ndarray:
+  """Sample num_samples from support in proportion to weights.
+
+  Args:
+      num_samples: The number of samples to return
+      support:  The elements from which to sample
+      weights:  The nonnegative weight of each element of the support
+
+  Returns:
+      A sample set from the weighted distribution over the support
+  """
+  if num_samples > len(support):
+    raise ValueError(
+        "When sampling without replacement, the number of samples"
+        " cannot exceed the cardinality of the set."
+    )
+  return rng.choice(
+      support, size=num_samples, replace=False, p=weights / np.sum(weights)
+  )
@@ -0,0 +1,191 @@
+# Copyright 2023 The triangulate Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Source utilities."""
+
+import array
+import bisect
+import hashlib
+import mmap
+import os
+from typing import Iterator, List, Tuple
+import weakref
+
+import numpy as np
+
+_NEWLINE = ord("\n")
+
+
+class SourceText:
+  """The immutable source of a subject program, shared by its episodes.
+
+  The source is held as UTF-8 encoded bytes, typically a memory map of the
+  subject's file, alongside the offset at which each line starts, so any line
+  or run of lines is decoded on demand without keeping a string per line.
+
+  Attributes:
+    line_offsets: the byte offset of the start of each line, followed by the
+      size of the source
+    digest: digest of the source, which identifies it
+  """
+
+  __slots__ = ("_buffer", "line_offsets", "digest", "__weakref__")
+
+  def __init__(self, buffer: bytes | mmap.mmap, digest: str):
+    self._buffer = buffer
+    self.digest = digest
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    ends = np.flatnonzero(data == _NEWLINE) + 1
+    if len(data) and data[-1] != _NEWLINE:
+      ends = np.append(ends, len(data))
+    self.line_offsets = np.concatenate(([0], ends)).astype(np.int64)
+
+  def __len__(self) -> int:
+    return len(self.line_offsets) - 1
+
+  def __getitem__(self, index: int) -> str:
+    """Return the line at `index`, ending with its newline."""
+    if index < 0:
+      index += len(self)
+    if not 0 <= index < len(self):
+      raise IndexError("source line out of range")
+    return self.segment(index, index + 1)
+
+  def segment(self, start: int, end: int | None = None) -> str:
+    """Return lines `start` up to, but excluding, `end` as a single string."""
+    offsets = self.line_offsets
+    end = len(self) if end is None else min(end, len(self))
+    if start >= end:
+      return ""
+    return self._buffer[offsets[start] : offsets[end]].decode("utf-8")
+
+  def text(self) -> str:
+    """Return the source as a single string."""
+    return self.segment(0)
+
+
+# Interned sources, which live as long as some state references them.
+_sources = weakref.WeakValueDictionary()
+
+
+def _intern(buffer: bytes | mmap.mmap) -> SourceText:
+  digest = hashlib.blake2b(buffer, digest_size=16).hexdigest()
+  source = _sources.get(digest)
+  if source is None:
+    source = SourceText(buffer, digest)
+    _sources[digest] = source
+  return source
+
+
+def intern_source(text: str) -> SourceText:
+  """Return the shared instance of the source whose contents are `text`.
+
+  Args:
+    text: contents of a subject program
+
+  Returns:
+    The single live `SourceText` with the given contents.
+  """
+  return _intern(text.encode("utf-8"))
+
+
+def load_source(path: str) -> SourceText:
+  """Return the shared instance of the source in the file at `path`.
+
+  The file is memory-mapped rather than read, so it must not be modified
+  while the source is in use: truncating a mapped file faults its readers.
+  Map a private snapshot, never a file the user may edit.
+
+  Args:
+    path: a subject program
+
+  Returns:
+    The single live `SourceText` with the file's contents.
+  """
+  with open(path, "rb") as f:
+    if os.fstat(f.fileno()).st_size == 0:
+      return _intern(b"")
+    buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  source = _intern(buffer)
+  if source._buffer is not buffer:  # pylint:disable=protected-access
+    buffer.close()
+  return source
+
+
+class ProbeOverlay:
+  """The probes an episode inserts into its subject's shared source.
+
+  Each probe is inserted before the line of the base source at its offset;
+  distinct probes at the same offset keep the order in which they were added.
+
+  Attributes:
+    offsets: sorted offsets of the probes into the base source
+    probes: probe statements, parallel to `offsets`
+  """
+
+  __slots__ = ("offsets", "probes")
+
+  def __init__(self):
+    self.offsets = array.array("q")
+    self.probes = []
+
+  def __len__(self) -> int:
+    return len(self.probes)
+
+  def __iter__(self) -> Iterator[Tuple[int, str]]:
+    return zip(self.offsets, self.probes)
+
+  def add(self, offset: int, probe: str) -> bool:
+    """Insert `probe` before line `offset` of the base source.
+
+    A probe identical to one already at `offset` is merged into it.
+
+    Args:
+      offset: the offset of the line before which to insert the probe
+      probe: the probe's statement
+
+    Returns:
+      Whether the probe was inserted, rather than merged.
+    """
+    start = bisect.bisect_left(self.offsets, offset)
+    index = bisect.bisect_right(self.offsets, offset, lo=start)
+    if probe in self.probes[start:index]:
+      return False
+    self.offsets.insert(index, offset)
+    self.probes.insert(index, probe)
+    return True
+
+  def clear(self) -> None:
+    """Remove every probe."""
+    del self.offsets[:]
+    self.probes.clear()
+
+  def materialise(self, source: SourceText) -> List[str]:
+    """Return `source` with the probes inserted.
+
+    Args:
+      source: the base source the overlay instruments
+
+    Returns:
+      The instrumented source, as runs of the base source's lines and the
+      probes between them, which concatenate to the instrumented program.
+    """
+    fragments = []
+    start = 0
+    for offset, probe in zip(self.offsets, self.probes):
+      fragments.append(source.segment(start, offset))
+      fragments.append(probe)
+      start = offset
+    fragments.append(source.segment(start))
+    return fragments
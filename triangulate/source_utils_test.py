@@ -0,0 +1,78 @@
+# Copyright 2023 The triangulate Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for source_utils."""
+
+import os
+import tempfile
+
+from absl.testing import absltest
+import numpy as np
+from triangulate import source_utils
+
+SOURCE = "a = 1\nb = 2\nc = 3\n"
+
+
+class SourceTextTest(absltest.TestCase):
+
+  def test_equal_sources_are_shared(self):
+    source = source_utils.intern_source(SOURCE)
+    self.assertIs(source_utils.intern_source(SOURCE), source)
+    self.assertIsNot(source_utils.intern_source(SOURCE + "d = 4\n"), source)
+    self.assertEqual(source[1], "b = 2\n")
+    self.assertEqual(source.text(), SOURCE)
+
+  def test_loaded_sources_are_indexed_by_line(self):
+    directory = self.enter_context(tempfile.TemporaryDirectory())
+    path = os.path.join(directory, "subject.py")
+    with open(path, "w", encoding="utf-8") as f:
+      f.write("é = 1\n\nc = 'ü'")
+    source = source_utils.load_source(path)
+    self.assertIs(source_utils.load_source(path), source)
+    self.assertEqual(source.line_offsets.dtype, np.int64)
+    np.testing.assert_array_equal(source.line_offsets, [0, 7, 8, 16])
+    self.assertLen(source, 3)
+    self.assertEqual(source[0], "é = 1\n")
+    self.assertEqual(source[-1], "c = 'ü'")
+    self.assertEqual(source.segment(1), "\nc = 'ü'")
+    with self.assertRaises(IndexError):
+      source[3]  # pylint:disable=pointless-statement
+
+  def test_empty_source(self):
+    source = source_utils.intern_source("")
+    self.assertEmpty(source)
+    self.assertEqual(source.text(), "")
+
+
+class ProbeOverlayTest(absltest.TestCase):
+
+  def test_materialise_inserts_probes_before_offsets(self):
+    source = source_utils.intern_source(SOURCE)
+    overlay = source_utils.ProbeOverlay()
+    overlay.add(2, "p2\n")
+    overlay.add(0, "p0\n")
+    overlay.add(2, "q2\n")
+    self.assertFalse(overlay.add(2, "p2\n"))
+    self.assertEqual(
+        "".join(overlay.materialise(source)),
+        "p0\na = 1\nb = 2\np2\nq2\nc = 3\n",
+    )
+    self.assertEqual(source.text(), SOURCE)
+    self.assertEqual(list(overlay), [(0, "p0\n"), (2, "p2\n"), (2, "q2\n")])
+    overlay.clear()
+    self.assertEqual(overlay.materialise(source), [SOURCE])
+
+
+if __name__ == "__main__":
+  absltest.main()
@@ -0,0 +1,102 @@
+# Copyright 2023 The triangulate Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark the startup time of fresh interpreters importing triangulate.
+
+Each module is imported by `--runs` fresh interpreters, as worker processes
+and command line invocations do, and the script reports the time each run
+takes along with the heavy dependencies the import loads.
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import List, Sequence
+
+from absl import app
+from absl import flags
+
+flags.DEFINE_list(
+    "modules",
+    [
+        "triangulate",
+        "triangulate.ast_utils",
+        "triangulate.exec_utils",
+        "triangulate.core",
+    ],
+    help="Modules whose import to time.",
+)
+flags.DEFINE_integer("runs", 20, help="Number of interpreters per module.")
+
+# Dependencies whose import dominates startup.
+HEAVY_DEPENDENCIES = ("absl", "asyncio", "numpy", "triangulate.core")
+# The directory holding the triangulate package.
+_PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _run(code: str) -> str:
+  env = dict(os.environ)
+  env["PYTHONPATH"] = os.pathsep.join(
+      filter(None, [_PACKAGE_ROOT, env.get("PYTHONPATH")])
+  )
+  return subprocess.run(
+      [sys.executable, "-c", code],
+      check=True,
+      capture_output=True,
+      env=env,
+      text=True,
+  ).stdout
+
+
+def heavy_imports(module: str) -> List[str]:
+  """Return the heavy dependencies a fresh interpreter loads with `module`."""
+  code = (
+      f"import sys, {module}; "
+      f"print(*(m for m in {HEAVY_DEPENDENCIES!r} if m in sys.modules))"
+  )
+  return _run(code).split()
+
+
+def time_startup(module: str, runs: int) -> List[float]:
+  """Return the wall time, in seconds, of each of `runs` imports of `module`."""
+  times = []
+  for _ in range(runs):
+    start = time.perf_counter()
+    _run(f"import {module}")
+    times.append(time.perf_counter() - start)
+  return times
+
+
+def main(argv: Sequence[str]) -> None:
+  """Program entry point."""
+
+  if len(argv) > 1:
+    raise app.UsageError("Too many command-line arguments.")
+
+  baseline = statistics.median(time_startup("sys", flags.FLAGS.runs))
+  print(f"{'module':<28} {'median ms':>10} {'min ms':>8}  heavy imports")
+  print(f"{'(bare interpreter)':<28} {1000 * baseline:>10.1f}")
+  for module in flags.FLAGS.modules:
+    times = time_startup(module, flags.FLAGS.runs)
+    heavy = ", ".join(heavy_imports(module)) or "-"
+    print(
+        f"{module:<28} {1000 * statistics.median(times):>10.1f}"
+        f" {1000 * min(times):>8.1f}  {heavy}"
+    )
+
+
+if __name__ == "__main__":
+  app.run(main)
@@ -0,0 +1,40 @@
+# Copyright 2023 The triangulate Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for startup_benchmark."""
+
+from absl.testing import absltest
+from absl.testing import parameterized
+from triangulate import startup_benchmark
+
+
+class StartupTest(parameterized.TestCase):
+
+  @parameterized.parameters(
+      "triangulate",
+      "triangulate.ast_utils",
+      "triangulate.exec_utils",
+  )
+  def test_light_modules_load_no_heavy_dependencies(self, module: str):
+    self.assertEmpty(startup_benchmark.heavy_imports(module))
+
+  def test_heavy_modules_are_detected(self):
+    self.assertContainsSubset(
+        ["numpy", "triangulate.core"],
+        startup_benchmark.heavy_imports("triangulate.batch_utils"),
+    )
+
+
+if __name__ == "__main__":
+  absltest.main()
@@ -0,0 +1,29 @@
+# Copyright 2023 The triangulate Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file is a test input to triangulate that holds unexecuted code."""
+
+
+def add(x, y):
+  return x + y
+
+
+def subtract(x, y):
+  return x - y
+
+
+total = add(2, 3)
+assert total == 5, f"The total {total} is not five."
+
+print(f"Total: {total}")
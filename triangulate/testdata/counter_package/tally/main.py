@@ -0,0 +1,24 @@
+# Copyright 2023 The triangulate Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file is the entry module of a package test input to triangulate."""
+
+from . import marks
+from .marks import MARKS
+
+total = marks.count(MARKS)
+
+assert total <= len(MARKS), f"The total {total} exceeds {len(MARKS)} marks."
+
+print(f"Counted {total} marks in package {__package__}")
@@ -0,0 +1,28 @@
+# Copyright 2023 The triangulate Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file is a nondeterministic test input to triangulate."""
+
+import os
+import random
+import time
+
+# Roll a die without seeding the generator
+roll = random.randint(1, 6)
+salt = os.urandom(4).hex()
+stamp = time.time()
+
+assert 1 <= roll <= 6, f"The roll {roll} is not a face of the die."
+
+print(f"Rolled {roll} with salt {salt} at {stamp}")
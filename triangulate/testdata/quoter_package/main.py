@@ -0,0 +1,31 @@
+# Copyright 2023 The triangulate Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file is the entry module of a multi-module test input to triangulate."""
+
+import random
+
+from quote_book import QUOTES
+
+random.seed(0)
+
+# Generate a random quote and attribution from the quote book
+quote, attribution = random.choice(list(QUOTES.items()))
+
+quote_to_check = "The only way to do great work is to love what you do."
+assert quote_to_check in QUOTES, f"The quote '{quote_to_check}' is not present."
+
+# Print the quote with its attribution
+print("Today's inspirational quote:")
+print(f'"{quote}" - {attribution}')
@@ -0,0 +1,24 @@
+# Copyright 2023 The triangulate Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file holds the quotes of a multi-module test input to triangulate."""
+
+QUOTES = {
+    "It does not matter how slowly you go as long as you do not stop.":
+        "Confucius",
+    "The only way to do great work is to love what you do.":
+        "Steve Jobs",
+    "Believe you can and you're halfway there.": "Theodore Roosevelt",
+    "You miss 100% of the shots you don't take.": "Wayne Gretzky",
+}
@@ -0,0 +1,191 @@
+# Copyright 2023 The triangulate Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Trajectory utilities.
+
+A trajectory directory holds append-only shards, each a directory of `.npy`
+files with one column per file, so that readers can memory-map any column.
+Per-step columns have one entry per step.  Ragged columns, like the offsets of
+a step's probes, are flattened; `<name>_splits` holds the index at which each
+step's entries start, followed by their total count.
+"""
+
+import os
+import re
+from typing import Dict, Iterator, Sequence
+
+import numpy as np
+
+# Columns with one entry per step and their types.
+STEP_COLUMNS = {
+    "episode": np.int64,
+    "step": np.int64,
+    "output_digest": np.uint64,
+    "execution_seconds": np.float64,
+    "reward": np.float64,
+}
+# Ragged columns and their types.
+RAGGED_COLUMNS = {
+    "probe_offsets": np.int64,
+    "observation_offsets": np.int64,
+    "observation_values": np.int8,
+}
+_SHARD_TEMPLATE = "shard-{:06d}"
+_SHARD_PATTERN = re.compile(r"shard-(\d{6})$")
+
+
+def _shard_indices(directory: str) -> list[int]:
+  return sorted(
+      int(match.group(1))
+      for match in map(_SHARD_PATTERN.match, os.listdir(directory))
+      if match
+  )
+
+
+def _first_new_episode(directory: str, shards: Sequence[int]) -> int:
+  """Return the episode following every episode recorded in `shards`."""
+  last_episode = -1
+  for index in shards:
+    episodes = np.load(
+        os.path.join(directory, _SHARD_TEMPLATE.format(index), "episode.npy"),
+        mmap_mode="r",
+    )
+    last_episode = max(last_episode, episodes.max(initial=-1))
+  return int(last_episode) + 1
+
+
+class TrajectoryRecorder:
+  """Append steps of one or more episodes to a trajectory directory.
+
+  Steps are buffered in memory and written as a new shard every `shard_size`
+  steps and on `close`.  Shards are written to a temporary directory and then
+  renamed, so readers never observe a partial shard.  Episode identifiers
+  continue from the largest already recorded in the directory, so recorders
+  that append to it in turn never reuse one.
+
+  Attributes:
+    directory: the trajectory directory
+    shard_size: the number of steps per shard
+  """
+
+  def __init__(self, directory: str, shard_size: int = 1024):
+    self.directory = directory
+    self.shard_size = shard_size
+    os.makedirs(directory, exist_ok=True)
+    shards = _shard_indices(directory)
+    self._next_shard = shards[-1] + 1 if shards else 0
+    self._next_episode = _first_new_episode(directory, shards)
+    self._buffer = {name: [] for name in (*STEP_COLUMNS, *RAGGED_COLUMNS)}
+
+  def __enter__(self) -> "TrajectoryRecorder":
+    return self
+
+  def __exit__(self, *exc_info) -> None:
+    self.close()
+
+  def new_episode(self) -> int:
+    """Return an identifier for an episode new to the trajectory directory."""
+    episode = self._next_episode
+    self._next_episode += 1
+    return episode
+
+  def record(
+      self,
+      episode: int,
+      step: int,
+      probe_offsets: Sequence[int],
+      observation_offsets: Sequence[int],
+      observation_values: Sequence[int],
+      output_digest: int,
+      execution_seconds: float,
+      reward: float,
+  ) -> None:
+    """Record a step.
+
+    Args:
+      episode: the episode to which the step belongs
+      step: the index of the step within its episode
+      probe_offsets: the offsets of the step's probes
+      observation_offsets: the offset of each probe observation, in order
+      observation_values: each observed value of the illegal state
+        expression: 1 for true, 0 for false and -1 otherwise
+      output_digest: digest of the subject's output
+      execution_seconds: time taken to execute the subject
+      reward: the step's reward
+    """
+    buffer = self._buffer
+    buffer["episode"].append(episode)
+    buffer["step"].append(step)
+    buffer["output_digest"].append(output_digest)
+    buffer["execution_seconds"].append(execution_seconds)
+    buffer["reward"].append(reward)
+    for name, row in (
+        ("probe_offsets", probe_offsets),
+        ("observation_offsets", observation_offsets),
+        ("observation_values", observation_values),
+    ):
+      buffer[name].append(np.array(row, dtype=RAGGED_COLUMNS[name]))
+    if len(buffer["step"]) >= self.shard_size:
+      self.flush()
+
+  def flush(self) -> None:
+    """Write the buffered steps as a new shard."""
+    if not self._buffer["step"]:
+      return
+    shard = os.path.join(
+        self.directory, _SHARD_TEMPLATE.format(self._next_shard)
+    )
+    partial_shard = shard + ".tmp"
+    os.makedirs(partial_shard, exist_ok=True)
+    for name, dtype in STEP_COLUMNS.items():
+      column = np.array(self._buffer[name], dtype=dtype)
+      np.save(os.path.join(partial_shard, name + ".npy"), column)
+    for name in RAGGED_COLUMNS:
+      rows = self._buffer[name]
+      splits = np.zeros(len(rows) + 1, dtype=np.int64)
+      np.cumsum([len(row) for row in rows], out=splits[1:])
+      column = np.concatenate(rows)
+      np.save(os.path.join(partial_shard, name + ".npy"), column)
+      np.save(os.path.join(partial_shard, name + "_splits.npy"), splits)
+    os.rename(partial_shard, shard)
+    self._next_shard += 1
+    for column in self._buffer.values():
+      column.clear()
+
+  def close(self) -> None:
+    """Write any buffered steps."""
+    self.flush()
+
+
+def read_trajectories(
+    directory: str, mmap: bool = True
+) -> Iterator[Dict[str, np.ndarray]]:
+  """Read the shards of a trajectory directory in the order they were written.
+
+  Args:
+    directory: the trajectory directory
+    mmap: whether to memory-map the columns rather than load them
+
+  Yields:
+    The columns of each shard, keyed by name.
+  """
+  mmap_mode = "r" if mmap else None
+  for index in _shard_indices(directory):
+    shard = os.path.join(directory, _SHARD_TEMPLATE.format(index))
+    yield {
+        os.path.splitext(filename)[0]: np.load(
+            os.path.join(shard, filename), mmap_mode=mmap_mode
+        )
+        for filename in sorted(os.listdir(shard))
+    }
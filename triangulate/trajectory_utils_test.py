@@ -0,0 +1,67 @@
+# Copyright 2023 The triangulate Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for trajectory_utils."""
+
+import tempfile
+
+from absl.testing import absltest
+import numpy as np
+from triangulate import trajectory_utils
+
+
+def _record(recorder, episode, step, probe_offsets, observations):
+  recorder.record(
+      episode=episode,
+      step=step,
+      probe_offsets=probe_offsets,
+      observation_offsets=[offset for offset, _ in observations],
+      observation_values=[value for _, value in observations],
+      output_digest=2**64 - 1,
+      execution_seconds=0.5,
+      reward=1.0,
+  )
+
+
+class TrajectoryRecorderTest(absltest.TestCase):
+
+  def test_shards_are_appended_and_memory_mapped(self):
+    directory = self.enter_context(tempfile.TemporaryDirectory())
+    with trajectory_utils.TrajectoryRecorder(directory, shard_size=2) as rec:
+      episode = rec.new_episode()
+      _record(rec, episode, 1, [3, 7], [(3, 0), (7, 1), (7, 1)])
+      _record(rec, episode, 2, [], [])
+      _record(rec, rec.new_episode(), 1, [5], [(5, -1)])
+    with trajectory_utils.TrajectoryRecorder(directory) as rec:
+      _record(rec, rec.new_episode(), 1, [2], [])
+
+    shards = list(trajectory_utils.read_trajectories(directory))
+    self.assertLen(shards, 3)
+    first = shards[0]
+    self.assertIsInstance(first["step"], np.memmap)
+    np.testing.assert_array_equal(first["step"], [1, 2])
+    np.testing.assert_array_equal(first["episode"], [0, 0])
+    np.testing.assert_array_equal(first["probe_offsets"], [3, 7])
+    np.testing.assert_array_equal(first["probe_offsets_splits"], [0, 2, 2])
+    np.testing.assert_array_equal(first["observation_values"], [0, 1, 1])
+    self.assertEqual(first["output_digest"][0], 2**64 - 1)
+    np.testing.assert_array_equal(shards[1]["observation_values"], [-1])
+    np.testing.assert_array_equal(shards[2]["probe_offsets"], [2])
+    # The second recorder continues the episodes of the first.
+    np.testing.assert_array_equal(shards[1]["episode"], [1])
+    np.testing.assert_array_equal(shards[2]["episode"], [2])
+
+
+if __name__ == "__main__":
+  absltest.main()